@@ -24,274 +24,1258 @@ import pwd
 import json
 import logging
 import yaml
+import csv
+import threading
+import Queue
+import SocketServer
+import httplib
+import socket
+import ssl
+import urllib
+import urlparse
+import errno
+import stat
+import contextlib
+import copy
+import re
+import tarfile
+import hashlib
+import io
 from collections import defaultdict
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # scandir backport, without it directories are listed with listdir and lstat
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    # pyxattr, without it extended attributes are not kept on cross device moves
+    import xattr
+except ImportError:
+    xattr = None
 logger = logging.getLogger(__name__)
+# where homes, zones, cPanel data and passwd are looked up, set_root moves them for tests
+ROOT = ''
+HOME_DIR = '/home/'
+NAMED_DIR = '/var/named/'
+USERDATA_DIR = '/var/cpanel/userdata/'
+USERS_DIR = '/var/cpanel/users/'
+DATABASES_DIR = '/var/cpanel/databases/'
+# root only staging of presynced copies, beside the homes so they rename into place
+PRESYNC_DIR = '/home/.cpmerge-presync/'
+# root only dir of the merge journals, a resume trusts what they say
+STATE_DIR = '/var/cpanel/cpmerge/'
+# tocp accounts already given unlimited quotas during this run
+UNLIMITED_QUOTA_USERS = set()
+# bounds concurrent cPanel API/script subprocesses across all running merges
+API_SLOTS = threading.BoundedSemaphore(8)
+# per domain API calls a single step may run at once
+DOMAIN_WORKERS = 4
+# files copied at once when a move has to cross filesystems
+COPY_WORKERS = 8
+COPY_CHUNK = 1024 * 1024
+# mailboxes moved at once
+MAIL_WORKERS = 8
+# message size dovecot/courier put in maildir file names
+MAILDIR_SIZE_RE = re.compile(r',S=(\d+)')
+# seconds between copy progress log lines
+PROGRESS_INTERVAL = 10
+# steps whose per domain calls run DOMAIN_WORKERS at a time
+CONCURRENT_STEPS = ('del_addon', 'add_addon', 'add_subdomain')
+# assumptions used to estimate how long a planned merge takes
+PLAN_API_SECONDS = 0.5
+PLAN_COPY_RATE = 100 * 1024 * 1024
+# directories scanned at once when fixing permissions of merged files
+FIXPERMS_WORKERS = 8
+# run cPanel's fixperms over all of tocp instead of only the merged paths
+FULL_FIXPERMS = False
+# one lock per tocp so merges into the same account never interleave their writes
+TARGET_LOCKS = defaultdict(threading.RLock)
+TARGET_LOCKS_GUARD = threading.Lock()
+# name and metrics of the merge the current thread works on
+_merge_context = threading.local()
+# prometheus textfile collector file and the metrics of every merge finished this run
+PROM_FILE = None
+FINISHED_METRICS = []
+FINISHED_METRICS_LOCK = threading.Lock()
+# libyaml backed parsers are several times faster than the pure python ones
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+# config snapshots taken before each merge, blobs are shared between snapshots
+SNAPSHOT_DIR = '/root/cpmerge-snapshots'
+SNAPSHOT_LOCK = threading.Lock()
+# keep fromcp's zones across the addon delete/re-add, restored in one batch at the end
+BULK_DNS = False
+DNS_RELOAD_COMMAND = ['rndc', 'reload']
+# present when the server is in a DNS cluster, the restored zones are then pushed to its peers
+DNS_CLUSTER_FLAG = '/var/cpanel/useclusteringdns'
+ZONE_SERIAL_RE = re.compile(r'(\bSOA\s+\S+\s+\S+\s*\(?\s*)(\d+)', re.I)
+# run the merge's operations as a dependency graph, or the steps one after another
+SERIAL_STEPS = False
+# graph operations are timed under the name of the step running them serially
+GRAPH_STEP_NAMES = {'move_maildir': 'move_maildirs', 'move_docroot': 'move_docroots', \
+                    'del_addon': 'del_addons', 'add_addon': 'add_addons', \
+                    'add_subdomain': 'add_subdomains'}
+# graph operations run after what they depend on even when some of it failed, they are
+# only journaled done when nothing before them failed so a resume covers the rest
+GRAPH_ALWAYS_STEPS = ('restore_zones', 'fix_perms')
+# admission control: share of each destination filesystem's space and inodes kept free,
+# the io pressure (PSI some avg10) merges wait below and how long they wait to be admitted
+MIN_FREE_FRACTION = 0.05
+IO_PRESSURE_LIMIT = None
+IO_PRESSURE_FILE = '/proc/pressure/io'
+ADMISSION_WAIT = 3600
+# bytes and inodes running merges have reserved on each destination filesystem, by st_dev
+RESERVATIONS = defaultdict(lambda: [0, 0])
+RESERVATIONS_LOCK = threading.Condition()
+def set_root(root):
+    """ Look for homes, zones, cPanel data and passwd under root instead of / """
+    global ROOT, HOME_DIR, NAMED_DIR, USERDATA_DIR, USERS_DIR, DATABASES_DIR, PRESYNC_DIR, \
+           STATE_DIR
+    ROOT = os.path.realpath(root) if root else ''
+    HOME_DIR = ROOT + '/home/'
+    NAMED_DIR = ROOT + '/var/named/'
+    USERDATA_DIR = ROOT + '/var/cpanel/userdata/'
+    USERS_DIR = ROOT + '/var/cpanel/users/'
+    DATABASES_DIR = ROOT + '/var/cpanel/databases/'
+    PRESYNC_DIR = HOME_DIR + '.cpmerge-presync/'
+    STATE_DIR = ROOT + '/var/cpanel/cpmerge/'
+def set_api_limit(limit):
+    """ Change how many cPanel API subprocesses may run at once """
+    global API_SLOTS
+    API_SLOTS = threading.BoundedSemaphore(max(1, limit))
+def run_api(command):
+    """ Run a cPanel API/script subprocess once an API slot is free """
+    with API_SLOTS:
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return proc.communicate()
+def set_domain_workers(width):
+    """ Change how many per domain API calls a step may run at once """
+    global DOMAIN_WORKERS
+    DOMAIN_WORKERS = max(1, width)
+def set_full_fixperms(full):
+    """ Choose between fixing only merged paths and running fixperms on all of tocp """
+    global FULL_FIXPERMS
+    FULL_FIXPERMS = full
+def set_copy_workers(width):
+    """ Change how many files a cross device move copies at once """
+    global COPY_WORKERS
+    COPY_WORKERS = max(1, width)
+def set_bulk_dns(bulk):
+    """ Choose between cPanel's recreated zones and restoring fromcp's in one batch """
+    global BULK_DNS
+    BULK_DNS = bulk
+def set_serial_steps(serial):
+    """ Choose between the dependency graph and running the merge steps one at a time """
+    global SERIAL_STEPS
+    SERIAL_STEPS = serial
+def set_io_budget(bandwidth=None, iops=None):
+    """ Cap the bytes and files per second all cross filesystem copies of the run share, None is no cap """
+    global IO_BUDGET
+    IO_BUDGET = IoBudget(bandwidth, iops)
+def set_admission(min_free=None, io_pressure=None, wait=None):
+    """ Change the free space headroom, io pressure limit and admission wait of merges """
+    global MIN_FREE_FRACTION, IO_PRESSURE_LIMIT, ADMISSION_WAIT
+    if min_free is not None:
+        MIN_FREE_FRACTION = min(max(0.0, min_free), 1.0)
+    IO_PRESSURE_LIMIT = io_pressure
+    if wait is not None:
+        ADMISSION_WAIT = max(0, wait)
+def set_mail_workers(width):
+    """ Change how many mailboxes are moved at once """
+    global MAIL_WORKERS
+    MAIL_WORKERS = max(1, width)
+def start_workers(target, count):
+    """
+    Start count daemon threads running target, they keep logging and metrics
+    going to the merge of the thread that started them
+    """
+    merge = getattr(_merge_context, 'merge', None)
+    metrics = getattr(_merge_context, 'metrics', None)
+    step = getattr(_merge_context, 'step', None)
+    def run():
+        _merge_context.merge = merge
+        _merge_context.metrics = metrics
+        _merge_context.step = step
+        target()
+    threads = [threading.Thread(target=run) for num in range(count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return threads
+def join_threads(threads):
+    """ Wait for threads with a timeout so ctrl-c still reaches the main thread """
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.5)
+def run_concurrently(func, items, width=None):
+    """
+    Call func on every item using up to width threads
+    Results come back in the order of items whatever order the calls finish in
+    """
+    items = list(items)
+    width = min(width or DOMAIN_WORKERS, len(items))
+    if width <= 1:
+        return [func(item) for item in items]
+    results = [None] * len(items)
+    failures = []
+    todo = Queue.Queue()
+    for index, item in enumerate(items):
+        todo.put((index, item))
+    def worker():
+        while True:
+            try:
+                index, item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                failures.append(sys.exc_info())
+    join_threads(start_workers(worker, width))
+    if failures:
+        exc_type, exc_value, exc_tb = failures[0]
+        raise exc_type, exc_value, exc_tb
+    return results
+def run_graph(operations, run_op, widths, always=(), skip_op=None):
+    """
+    Run operations, dicts with a key, step, kind, the keys they depend on and
+    optionally the keys they only run after, each as soon as all of those
+    have finished, on widths[kind]
+    threads per kind so io and api work overlap, the ready operation with the
+    longest chain of operations waiting on it first
+    run_op(op) returns True on success, an operation depending on one that
+    failed or was skipped is handed to skip_op instead unless its step is in
+    always, returns {key: True, False or None when skipped}
+    """
+    keys = set(op['key'] for op in operations)
+    waiting = defaultdict(list)
+    for op in operations:
+        for dep in op['depends'] + op.get('after', []):
+            waiting[dep].append(op['key'])
+    # operations come after what they depend on, so walking them backwards sees dependents first
+    chain = {}
+    for op in reversed(operations):
+        chain[op['key']] = 1 + max([chain.get(key, 0) for key in waiting[op['key']]] or [0])
+    pending = sorted(operations, key=lambda op: -chain[op['key']])
+    results = {}
+    failures = []
+    ready = threading.Condition()
+    def take(kind):
+        """ Wait for the next of kind's operations with all its dependencies finished """
+        with ready:
+            while True:
+                if failures:
+                    return None
+                for op in pending:
+                    if op['kind'] == kind and all(dep in results for dep in op['depends'] + op.get('after', []) \
+                                                  if dep in keys):
+                        pending.remove(op)
+                        return op
+                if not any(op['kind'] == kind for op in pending):
+                    return None
+                ready.wait(0.5)
+    def worker(kind):
+        while True:
+            op = take(kind)
+            if op is None:
+                return
+            failed = [dep for dep in op['depends'] if dep in keys and not results[dep]]
+            try:
+                if failed and op['step'] not in always:
+                    result = None
+                    if skip_op is not None:
+                        skip_op(op, failed[0])
+                else:
+                    result = bool(run_op(op))
+            except Exception:
+                result = False
+                failures.append(sys.exc_info())
+            with ready:
+                results[op['key']] = result
+                ready.notify_all()
+    threads = []
+    for kind in sorted(set(op['kind'] for op in operations)):
+        count = min(widths.get(kind, 1), len([op for op in operations if op['kind'] == kind]))
+        threads += start_workers(lambda kind=kind: worker(kind), count)
+    join_threads(threads)
+    if failures:
+        exc_type, exc_value, exc_tb = failures[0]
+        raise exc_type, exc_value, exc_tb
+    return results
+def target_lock(tocp):
+    """ Get the lock guarding writes to a tocp account """
+    with TARGET_LOCKS_GUARD:
+        return TARGET_LOCKS[tocp]
+def set_merge_context(tocp, fromcp):
+    """ Tag log records from this thread with the merge it is working on """
+    _merge_context.merge = fromcp + '=>' + tocp
+class ApiResult:
+    """ Outcome of a cPanel API call, the same for every backend """
+    def __init__(self, api, output, err=''):
+        self.output = output
+        self.err = err
+        self.data = None
+        self.ok = False
+        try:
+            payload = json.loads(output)
+        except (TypeError, ValueError):
+            return
+        if api == 'whmapi1':
+            self.data = payload.get('data')
+            self.ok = payload.get('metadata', {}).get('result') == 1
+        elif api == 'cpapi2':
+            result = payload.get('cpanelresult', {})
+            self.data = result.get('data')
+            # api2 reports per call failures inside data, the event only covers dispatch
+            items = self.data if isinstance(self.data, list) else []
+            self.ok = result.get('event', {}).get('result') == 1 and not result.get('error') \
+                    and all(item.get('result', 1) == 1 for item in items if isinstance(item, dict))
+        else:
+            result = payload.get('result', {})
+            self.data = result.get('data')
+            self.ok = result.get('status') == 1
+class CliBackend:
+    """ Call the cPanel APIs by running whmapi1/cpapi2/uapi, one process per call """
+    def call(self, api, func, args, user=None, module=None):
+        command = [api]
+        if user is not None:
+            command.append('--user=' + user)
+        if module is not None:
+            command.append(module)
+        command.append(func)
+        command.extend(key + '=' + str(value) for key, value in sorted(args.items()))
+        command.append('--output=json')
+        output, err = run_api(command)
+        return ApiResult(api, output, err)
+    def script(self, command):
+        return run_api(command)
+def is_stale_connection(err):
+    """ Tell whether a request failed because the server had closed the connection unanswered """
+    if isinstance(err, httplib.BadStatusLine):
+        return True
+    return isinstance(err, socket.error) and not isinstance(err, socket.timeout) and \
+        err.errno in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+class HttpBackend:
+    """
+    Call the cPanel APIs through WHM's json-api over keep-alive connections
+    Idle connections are pooled across threads so they outlive the workers
+    that opened them, calls fall back to the cli when the API port can't be
+    reached
+    """
+    def __init__(self, url='https://127.0.0.1:2087', token=None, fallback=None, timeout=300):
+        parsed = urlparse.urlparse(url)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port or (2087 if self.scheme == 'https' else 2086)
+        self.auth = 'whm root:' + ''.join((token or '').split())
+        self.fallback = fallback
+        self.timeout = timeout
+        self.idle = [] # open connections no call is using, at most one per API slot
+        self.lock = threading.Lock()
+    def connect(self, fresh=False):
+        """ Take an idle connection, or a new one if there is none or fresh is set """
+        with self.lock:
+            if self.idle and not fresh:
+                return self.idle.pop()
+        if self.scheme == 'https':
+            # WHM on localhost serves a self signed certificate
+            context = ssl._create_unverified_context()
+            return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=context)
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+    def release(self, conn):
+        """ Keep a connection whose response was read in full for the next call """
+        with self.lock:
+            self.idle.append(conn)
+    def path(self, api, func, args, user=None, module=None):
+        """ Build the json-api request path for a call """
+        query = sorted((key, str(value)) for key, value in args.items())
+        if api == 'whmapi1':
+            return '/json-api/' + func + '?' + urllib.urlencode([('api.version', 1)] + query)
+        params = [('cpanel_jsonapi_user', user), ('cpanel_jsonapi_module', module), \
+                  ('cpanel_jsonapi_func', func), \
+                  ('cpanel_jsonapi_apiversion', 2 if api == 'cpapi2' else 3)]
+        return '/json-api/cpanel?' + urllib.urlencode(params + query)
+    def call(self, api, func, args, user=None, module=None):
+        path = self.path(api, func, args, user, module)
+        with API_SLOTS:
+            # a retry opens a new connection, the other idle ones may be stale too
+            for attempt in range(2):
+                conn = self.connect(fresh=attempt > 0)
+                reused = conn.sock is not None
+                if not reused:
+                    try:
+                        conn.connect()
+                    except (httplib.HTTPException, socket.error) as err:
+                        conn.close()
+                        break
+                try:
+                    conn.request('GET', path, headers={'Authorization': self.auth})
+                    response = conn.getresponse()
+                    output = response.read()
+                except (httplib.HTTPException, socket.error) as err:
+                    conn.close()
+                    # only retry when the server had closed an idle connection before
+                    # answering, anything else may have run the call already
+                    if reused and is_stale_connection(err):
+                        continue
+                    return ApiResult(api, '', 'Request to {}://{}:{} failed: {}'.format( \
+                                     self.scheme, self.host, self.port, err))
+                self.release(conn)
+                if response.status == 200:
+                    return ApiResult(api, output)
+                return ApiResult(api, output, 'HTTP {} {}'.format(response.status, response.reason))
+        if self.fallback is None:
+            return ApiResult(api, '', 'Unable to reach {}://{}:{}: {}'.format(self.scheme, \
+                             self.host, self.port, err))
+        logger.debug("WHM API unreachable ({}), using cli for {} {}".format(err, api, func))
+        return self.fallback.call(api, func, args, user, module)
+    def script(self, command):
+        # scripts have no json-api equivalent, run them on the server
+        return run_api(command)
+class FakeBackend:
+    """
+    Answer every call with success after latency seconds without touching the
+    server, for benchmarks and tests run with a root prefix. Users exist if
+    the passwd file has them, listdbs and domains_data are empty so domains
+    have to be in userdata
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+    def call(self, api, func, args, user=None, module=None):
+        # hold an api slot like a subprocess would so --api-limit still applies
+        with API_SLOTS:
+            time.sleep(self.latency)
+        if api == 'whmapi1':
+            data = {}
+            if func == 'validate_system_user':
+                try:
+                    get_user_ids(args.get('user'))
+                    data['exists'] = 1
+                except KeyError:
+                    data['exists'] = 0
+            payload = {'metadata': {'result': 1}, 'data': data}
+        elif api == 'cpapi2':
+            data = [] if func == 'listdbs' else [{'result': 1}]
+            payload = {'cpanelresult': {'event': {'result': 1}, 'data': data}}
+        else:
+            payload = {'result': {'status': 1, 'data': {}}}
+        return ApiResult(api, json.dumps(payload))
+    def script(self, command):
+        # never run the server's binaries against a root prefix
+        with API_SLOTS:
+            time.sleep(self.latency)
+        return '', ''
+API_BACKEND = CliBackend()
+def set_api_backend(backend):
+    """ Choose how cPanel API calls are made """
+    global API_BACKEND
+    API_BACKEND = backend
+def call_api(api, func, args, user=None, module=None):
+    """ Make an API call through API_BACKEND, timing it for the merge's metrics """
+    start = time.time()
+    result = API_BACKEND.call(api, func, args, user, module)
+    metrics = getattr(_merge_context, 'metrics', None)
+    if metrics is not None:
+        name = func if module is None else module + '::' + func
+        metrics.record_api(api, name, time.time() - start, result.ok)
+    return result
+def run_script(command):
+    """ Run a cPanel script through API_BACKEND, returning its output and errors """
+    return API_BACKEND.script(command)
+def whmapi1(func, **args):
+    """ Call a WHM API 1 function """
+    return call_api('whmapi1', func, args)
+def cpapi2(user, module, func, **args):
+    """ Call a cPanel API 2 function as user """
+    return call_api('cpapi2', func, args, user, module)
+def uapi(user, module, func, **args):
+    """ Call a UAPI function as user """
+    return call_api('uapi', func, args, user, module)
+class MergeLogFilter(logging.Filter):
+    """ Tag records with their merge, optionally only passing records of one merge """
+    def __init__(self, merge=None):
+        logging.Filter.__init__(self)
+        self.merge = merge
+    def filter(self, record):
+        record.merge = getattr(_merge_context, 'merge', None) or '-'
+        return self.merge is None or record.merge == self.merge
+class CopyProgress:
+    """ Count copied bytes and log the throughput every PROGRESS_INTERVAL seconds """
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.start = self.reported = time.time()
+        self.lock = threading.Lock()
+    def rate(self):
+        """ Bytes per second so far """
+        return self.done / max(time.time() - self.start, 0.001)
+    def add(self, count):
+        with self.lock:
+            self.done += count
+            if time.time() - self.reported >= PROGRESS_INTERVAL:
+                self.reported = time.time()
+                logger.info("Copying {}: {:.1f} of {:.1f} MB ({:.1f} MB/s)".format(self.label, \
+                            self.done / 1048576.0, self.total / 1048576.0, self.rate() / 1048576.0))
+class IoBudget:
+    """
+    Bandwidth and IOPS budgets shared by every copy in the run, callers
+    sleep when they get ahead of them, with up to a second of burst
+    """
+    def __init__(self, bandwidth=None, iops=None):
+        self.bandwidth = bandwidth # bytes per second
+        self.iops = iops # files per second
+        self.lock = threading.Lock()
+        self.byte_clock = self.op_clock = 0.0
+    def spend(self, count=0, ops=0):
+        """ Account for count bytes and ops files, waiting until the budgets allow them """
+        if not self.bandwidth and not self.iops:
+            return
+        with self.lock:
+            now = time.time()
+            wait = 0.0
+            if self.bandwidth and count:
+                self.byte_clock = max(self.byte_clock, now - 1.0) + count / float(self.bandwidth)
+                wait = max(wait, self.byte_clock - now)
+            if self.iops and ops:
+                self.op_clock = max(self.op_clock, now - 1.0) + ops / float(self.iops)
+                wait = max(wait, self.op_clock - now)
+        if wait > 0:
+            time.sleep(wait)
+IO_BUDGET = IoBudget()
+def copy_xattrs(src, dst):
+    """ Copy extended attributes when pyxattr is installed """
+    if xattr is None:
+        return
+    for name in xattr.list(src, nofollow=True):
+        xattr.set(dst, name, xattr.get(src, name, nofollow=True), nofollow=True)
+def copy_metadata(src, dst, st):
+    """ Give dst the ownership, mode, times and xattrs of src """
+    os.lchown(dst, st.st_uid, st.st_gid)
+    if not stat.S_ISLNK(st.st_mode):
+        # chmod after chown, chown drops setuid/setgid bits
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+        os.utime(dst, (st.st_atime, st.st_mtime))
+    copy_xattrs(src, dst)
+def copy_file(src, dst, st, progress):
+    """ Copy a regular file's data and metadata within the run's IO_BUDGET """
+    IO_BUDGET.spend(ops=1)
+    with open(src, 'rb') as infile:
+        with open(dst, 'wb') as outfile:
+            while True:
+                chunk = infile.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                IO_BUDGET.spend(len(chunk))
+                outfile.write(chunk)
+                progress.add(len(chunk))
+    copy_metadata(src, dst, st)
+def scan_tree(src, dst):
+    """
+    List what copying src to dst involves without following symlinks
+    returns (dirs, files, hardlinks, specials, total bytes), hardlinks pair a
+    destination path with the already copied path it should link to
+    """
+    dirs, files, hardlinks, specials = [], [], [], []
+    first_copy = {}
+    total = 0
+    pending = [(src, dst)]
+    while pending:
+        src_path, dst_path = pending.pop()
+        st = os.lstat(src_path)
+        if stat.S_ISDIR(st.st_mode):
+            dirs.append((src_path, dst_path, st))
+            for name in sorted(os.listdir(src_path), reverse=True):
+                pending.append((os.path.join(src_path, name), os.path.join(dst_path, name)))
+        elif stat.S_ISREG(st.st_mode):
+            inode = (st.st_dev, st.st_ino)
+            if st.st_nlink > 1 and inode in first_copy:
+                hardlinks.append((first_copy[inode], dst_path))
+                continue
+            first_copy[inode] = dst_path
+            files.append((src_path, dst_path, st))
+            total += st.st_size
+        else:
+            specials.append((src_path, dst_path, st))
+    return dirs, files, hardlinks, specials, total
+def tree_totals(path, skip=()):
+    """
+    Count entries and regular file bytes below path, hardlinked data counts once
+    directories in skip are left out
+    """
+    entries = 0
+    total = 0
+    inodes = set()
+    pending = [path]
+    while pending:
+        current = pending.pop()
+        if current in skip:
+            continue
+        st = os.lstat(current)
+        entries += 1
+        if stat.S_ISDIR(st.st_mode):
+            pending.extend(os.path.join(current, name) for name in os.listdir(current))
+        elif stat.S_ISREG(st.st_mode) and (st.st_dev, st.st_ino) not in inodes:
+            inodes.add((st.st_dev, st.st_ino))
+            total += st.st_size
+    return entries, total
+def mismatched_copy(files):
+    """ The first copied (src, dst, src lstat) file whose copy differs in type, size or mtime, else None """
+    for src_path, dst_path, st in files:
+        try:
+            dst_st = os.lstat(dst_path)
+        except OSError:
+            return dst_path
+        if not stat.S_ISREG(dst_st.st_mode) or dst_st.st_size != st.st_size or \
+           int(dst_st.st_mtime) != int(st.st_mtime):
+            return dst_path
+    return None
+def copy_tree(src, dst):
+    """
+    Copy src to dst on COPY_WORKERS threads keeping ownership, modes, times,
+    hardlinks and xattrs, then verify dst has src's entry count and each
+    file's size and mtime, returns bytes copied
+    """
+    dirs, files, hardlinks, specials, total = scan_tree(src, dst)
+    progress = CopyProgress(src, total)
+    for src_path, dst_path, st in dirs:
+        os.mkdir(dst_path, 0o700)
+    run_concurrently(lambda entry: copy_file(entry[0], entry[1], entry[2], progress), \
+                     files, COPY_WORKERS)
+    for link_to, dst_path in hardlinks:
+        os.link(link_to, dst_path)
+    for src_path, dst_path, st in specials:
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src_path), dst_path)
+        elif stat.S_ISFIFO(st.st_mode):
+            os.mkfifo(dst_path)
+        else:
+            logger.warning("Not copying special file {}".format(src_path))
+            continue
+        copy_metadata(src_path, dst_path, st)
+    # deepest directories first so copying into them doesn't reset a parent's mtime
+    for src_path, dst_path, st in reversed(dirs):
+        copy_metadata(src_path, dst_path, st)
+    expected = (len(dirs) + len(files) + len(hardlinks) + \
+                len([entry for entry in specials if os.path.lexists(entry[1])]), total)
+    mismatch = mismatched_copy(files)
+    if mismatch is not None or tree_totals(dst) != expected:
+        raise OSError(errno.EIO, "Copy of {} to {} failed verification".format(src, dst), mismatch or dst)
+    logger.info("Copied {} to {}: {:.1f} MB in {:.1f}s ({:.1f} MB/s)".format(src, dst, \
+                total / 1048576.0, time.time() - progress.start, progress.rate() / 1048576.0))
+    return total
+def file_digest(path):
+    """ sha256 of a file's content """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        while True:
+            chunk = infile.read(COPY_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+def is_synced(src, dst, st, dst_st, checksum=False):
+    """ Check if the regular file dst already holds src's data, by size and mtime or by content """
+    if dst_st is None or not stat.S_ISREG(dst_st.st_mode) or st.st_size != dst_st.st_size:
+        return False
+    if checksum:
+        return file_digest(src) == file_digest(dst)
+    return int(st.st_mtime) == int(dst_st.st_mtime)
+def sync_tree(src, dst, skip=(), checksum=False):
+    """
+    Make dst a copy of src by copying only what changed since the last sync,
+    deleting what src no longer has, then verify it, returns bytes copied
+    directories in skip are left out, files are copied on COPY_WORKERS threads
+    """
+    dirs, copies, hardlinks = [], [], []
+    first_copy = {}
+    entries = total = 0
+    pending = [(src, dst)]
+    while pending:
+        src_path, dst_path = pending.pop()
+        st = os.lstat(src_path)
+        try:
+            dst_st = os.lstat(dst_path)
+        except OSError:
+            dst_st = None
+        entries += 1
+        if stat.S_ISDIR(st.st_mode):
+            if dst_st is not None and not stat.S_ISDIR(dst_st.st_mode):
+                remove_tree(dst_path)
+                dst_st = None
+            if dst_st is None:
+                os.mkdir(dst_path, 0o700)
+            dirs.append((src_path, dst_path, st))
+            names = [name for name in os.listdir(src_path) if os.path.join(src_path, name) not in skip]
+            for name in set(os.listdir(dst_path)) - set(names):
+                remove_tree(os.path.join(dst_path, name))
+            for name in sorted(names, reverse=True):
+                pending.append((os.path.join(src_path, name), os.path.join(dst_path, name)))
+        elif stat.S_ISREG(st.st_mode):
+            inode = (st.st_dev, st.st_ino)
+            if st.st_nlink > 1 and inode in first_copy:
+                hardlinks.append((first_copy[inode], dst_path))
+                continue
+            first_copy[inode] = dst_path
+            total += st.st_size
+            if not is_synced(src_path, dst_path, st, dst_st, checksum):
+                copies.append((src_path, dst_path, st))
+            elif (dst_st.st_uid, dst_st.st_gid, dst_st.st_mode) != (st.st_uid, st.st_gid, st.st_mode):
+                copy_metadata(src_path, dst_path, st)
+        elif stat.S_ISLNK(st.st_mode):
+            if dst_st is None or not stat.S_ISLNK(dst_st.st_mode) or \
+               os.readlink(dst_path) != os.readlink(src_path):
+                if dst_st is not None:
+                    remove_tree(dst_path)
+                os.symlink(os.readlink(src_path), dst_path)
+                copy_metadata(src_path, dst_path, st)
+        elif stat.S_ISFIFO(st.st_mode):
+            if dst_st is None or not stat.S_ISFIFO(dst_st.st_mode):
+                if dst_st is not None:
+                    remove_tree(dst_path)
+                os.mkfifo(dst_path)
+                copy_metadata(src_path, dst_path, st)
+        else:
+            logger.warning("Not copying special file {}".format(src_path))
+            entries -= 1
+    progress = CopyProgress(src, sum(entry[2].st_size for entry in copies))
+    def copy(entry):
+        # replace rather than overwrite, dst may be hardlinked elsewhere or a directory src replaced
+        if os.path.lexists(entry[1]):
+            remove_tree(entry[1])
+        copy_file(entry[0], entry[1], entry[2], progress)
+    run_concurrently(copy, copies, COPY_WORKERS)
+    for link_to, dst_path in hardlinks:
+        if os.path.lexists(dst_path):
+            if os.path.samefile(link_to, dst_path):
+                continue
+            remove_tree(dst_path)
+        os.link(link_to, dst_path)
+    for src_path, dst_path, st in reversed(dirs):
+        copy_metadata(src_path, dst_path, st)
+    mismatch = mismatched_copy(copies)
+    if mismatch is not None or tree_totals(dst) != (entries, total):
+        raise OSError(errno.EIO, "Sync of {} to {} failed verification".format(src, dst), mismatch or dst)
+    logger.info("Synced {} to {}: {} files, {:.1f} MB changed".format(src, dst, len(copies), \
+                progress.total / 1048576.0))
+    return progress.total
+def remove_tree(path):
+    """ Remove a file, symlink or directory tree """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+def move_tree(src, dst, copied_callback=None, staged=None):
+    """
+    Move src to dst, dst must not exist yet
+    Renames within a filesystem, across filesystems copies in parallel,
+    verifies the copy and only then removes src, returns bytes copied
+    copied_callback is called between verifying a copy and removing src
+    a presynced copy at staged only gets the last changes and is renamed to dst
+    """
+    if os.path.lexists(dst):
+        raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+    start = time.time()
+    metrics = getattr(_merge_context, 'metrics', None)
+    if os.lstat(src).st_dev == os.stat(os.path.dirname(os.path.normpath(dst))).st_dev:
+        try:
+            os.rename(src, dst)
+            if metrics is not None:
+                metrics.record_move(src, dst, 0, time.time() - start)
+            return 0
+        except OSError as err:
+            # bind mounts share a device number but still can't be renamed across
+            if err.errno != errno.EXDEV:
+                raise
+    if staged is not None and os.path.lexists(staged):
+        logger.info("Syncing the last changes of {} into its presynced copy".format(src))
+        copied = sync_tree(src, staged)
+        os.rename(staged, dst)
+    else:
+        logger.info("{} and {} are on different filesystems, copying".format(src, dst))
+        copied = copy_tree(src, dst)
+    if copied_callback is not None:
+        copied_callback()
+    remove_tree(src)
+    if metrics is not None:
+        metrics.record_move(src, dst, copied, time.time() - start)
+    return copied
+def journaled_move(cp_obj, key, src, dst):
+    """
+    Move src to dst unless the journal has key done, an interrupted move is
+    picked up where it stopped: a partial copy is discarded and redone, a
+    verified copy only has its source removed
+    """
+    journal = cp_obj.journal
+    state = journal.state(key)
+    if state == 'done':
+        logger.debug("Skipping {}: already done".format(key))
+        return
+    if state == 'copied':
+        if os.path.lexists(src):
+            remove_tree(src)
+    elif state == 'started' and os.path.lexists(dst) and not os.path.lexists(src):
+        logger.debug("{} was moved before the merge stopped".format(key))
+    elif not os.path.lexists(src):
+        logger.debug("Skipping {}: {} does not exist".format(key, src))
+        return
+    else:
+        if state == 'started' and os.path.lexists(dst):
+            logger.info("Discarding incomplete copy {}".format(dst))
+            remove_tree(dst)
+        elif os.path.lexists(dst):
+            # fail before journaling, a resume must not take dst for our partial copy
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+        journal.mark(key, 'started')
+        move_tree(src, dst, lambda: journal.mark(key, 'copied'), presynced_copy(cp_obj.tocp, cp_obj.fromcp, dst))
+    journal.mark(key)
+def list_dir(path):
+    """ (path, lstat) of every entry in a directory """
+    if scandir is None:
+        return [(os.path.join(path, name), os.lstat(os.path.join(path, name))) for name in os.listdir(path)]
+    return [(entry.path, entry.stat(follow_symlinks=False)) for entry in scandir(path)]
+def fix_entry(cp_obj, path, st, web):
+    """
+    Hand an entry fromcp owns over to tocp, in docroots also use the modes
+    fixperms uses: 755 dirs, 644 files, 755 for files the owner can execute
+    returns True if anything had to change
+    """
+    changed = False
+    uid = cp_obj.uid if st.st_uid == cp_obj.from_uid else -1
+    gid = cp_obj.gid if st.st_gid == cp_obj.from_gid else -1
+    if uid != -1 or gid != -1:
+        os.lchown(path, uid, gid)
+        changed = True
+    if web and (stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode)):
+        mode = stat.S_IMODE(st.st_mode)
+        wanted = 0o755 if stat.S_ISDIR(st.st_mode) or mode & stat.S_IXUSR else 0o644
+        # chown clears setuid/setgid so the mode has to be set again after it
+        if mode != wanted or (changed and mode & (stat.S_ISUID | stat.S_ISGID)):
+            os.chmod(path, wanted)
+            changed = True
+    return changed
+def fix_tree(cp_obj, roots):
+    """
+    Run fix_entry over every (path, web) root and everything below it,
+    directories are scanned in parallel on FIXPERMS_WORKERS threads
+    returns (entries checked, entries changed)
+    """
+    todo = Queue.Queue()
+    counts = {'checked': 0, 'changed': 0}
+    lock = threading.Lock()
+    def check(path, st, web):
+        changed = fix_entry(cp_obj, path, st, web)
+        with lock:
+            counts['checked'] += 1
+            counts['changed'] += int(changed)
+        if stat.S_ISDIR(st.st_mode):
+            todo.put((path, web))
+    def worker():
+        while True:
+            job = todo.get()
+            if job is None:
+                return
+            try:
+                for path, st in list_dir(job[0]):
+                    check(path, st, job[1])
+            except (OSError, IOError) as err:
+                logger.error("Error fixing permissions under {}: {}".format(job[0], os.strerror(err.errno)))
+                cp_obj.has_errors = True
+            finally:
+                todo.task_done()
+    for path, web in roots:
+        try:
+            if os.path.lexists(path):
+                check(path, os.lstat(path), web)
+        except (OSError, IOError) as err:
+            logger.error("Error fixing permissions of {}: {}".format(path, os.strerror(err.errno)))
+            cp_obj.has_errors = True
+    threads = start_workers(worker, FIXPERMS_WORKERS)
+    todo.join()
+    for thread in threads:
+        todo.put(None)
+    join_threads(threads)
+    return counts['checked'], counts['changed']
+def merged_paths(cp_obj):
+    """ (path, web) of everything the merge moved into tocp before the home dir """
+    paths = [(cp_obj.merge_dir, True)]
+    for domain in sorted(list(cp_obj.domains["addondomains"]) + list(cp_obj.domains["subdomains"]) + \
+                         list(cp_obj.domains["main"])):
+        for kind in ('mail', 'etc'):
+            paths.append((HOME_DIR + cp_obj.tocp + '/' + kind + '/' + domain, False))
+    return paths
 def fix_perms(cp_obj):
-    proc = subprocess.Popen(['/usr/bin/fixperms', cp_obj.tocp], \
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, err = proc.communicate()
+    """ Fix ownership and permissions of what the merge moved, or of all of tocp with FULL_FIXPERMS """
+    if FULL_FIXPERMS:
+        try:
+            output, err = run_script(['/usr/bin/fixperms', cp_obj.tocp])
+        except OSError as err:
+            logger.error("Error running fixperms: {}".format(os.strerror(err.errno)))
+            cp_obj.has_errors = True
+            return
+        if err:
+            logger.warning("fixperms reported: \n{}".format(err))
+        return
+    logger.info("Fixing permissions of merged files...")
+    checked, changed = fix_tree(cp_obj, merged_paths(cp_obj))
+    logger.info("Fixed permissions of {} of {} merged entries".format(changed, checked))
 def rename_main(cp_obj):
     """ Rename primary domain to prevent domain name conflict """
     for domain in cp_obj.domains["main"]:
+        if cp_obj.journal.is_done('rename_main:' + domain):
+            continue
         logger.info("Changing primary domain of fromcp cpanel...")
-        call_user = 'user=' + cp_obj.fromcp
-        call_domain = 'domain=' + domain + '.cpmerge'
-        proc = subprocess.Popen(['whmapi1', 'modifyacct', call_user, call_domain], \
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, err = proc.communicate()
-        if 'result: 1' not in output:
-            logger.error("Renaming primary domain failed.\n {} \n {}".format(output, err))
+        result = whmapi1('modifyacct', user=cp_obj.fromcp, domain=domain + '.cpmerge')
+        if not result.ok:
+            logger.error("Renaming primary domain failed.\n {} \n {}".format(result.output, result.err))
             cp_obj.has_errors = True
+        else:
+            cp_obj.journal.mark('rename_main:' + domain)
 def add_main(cp_obj):
     """ Add the fromcp's primary domain to tocp cpanel as an addon """
     for domain in cp_obj.domains["main"]:
+        if cp_obj.journal.is_done('add_main:' + domain):
+            continue
         logger.info("Adding main domain {}".format(domain))
-        call_user = '--user=' + cp_obj.tocp
-        call_domain = 'newdomain=' + domain
-        call_subdomain = 'subdomain=' + domain.split('.', 1)[0]
-        call_docroot = 'dir=' + cp_obj.merge_dir + domain
-        proc = subprocess.Popen(['cpapi2', call_user, 'AddonDomain', 'addaddondomain', \
-                                call_docroot, call_domain, call_subdomain], \
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, err = proc.communicate()
-        if 'result: 1' not in output:
-            logger.error("Adding main domain failed.\n {} \n {}".format(output, err))
+        result = cpapi2(cp_obj.tocp, 'AddonDomain', 'addaddondomain', dir=cp_obj.paths.docroots[domain], \
+                        newdomain=domain, subdomain=domain.split('.', 1)[0])
+        if not result.ok:
+            logger.error("Adding main domain failed.\n {} \n {}".format(result.output, result.err))
+            cp_obj.failed_domains.add(domain)
             cp_obj.has_errors = True
+        else:
+            cp_obj.journal.mark('add_main:' + domain)
 def move_homedir(cp_obj):
     """ Move fromcps home directory """
-    if is_realpath(cp_obj, '/home/' + cp_obj.fromcp):
+    if is_realpath(cp_obj, HOME_DIR + cp_obj.fromcp):
         try:
-            shutil.move('/home/' + cp_obj.fromcp, '/home/' + cp_obj.tocp)
-            os.chown('/home/' + cp_obj.tocp + '/' + cp_obj.fromcp, cp_obj.uid, cp_obj.gid)
+            journaled_move(cp_obj, 'move_homedir:' + cp_obj.fromcp, HOME_DIR + cp_obj.fromcp, \
+                           HOME_DIR + cp_obj.tocp + '/' + cp_obj.fromcp)
+            fix_tree(cp_obj, [(HOME_DIR + cp_obj.tocp + '/' + cp_obj.fromcp, False)])
         except (OSError, IOError) as err:
             logger.error("Error moving home dir: \n{}".format(os.strerror(err.errno)))
+def mailbox_names(cp_obj, domain):
+    """ Entries of fromcp's mail/<domain>, None when it isn't a real directory to split up """
+    src = HOME_DIR + cp_obj.fromcp + '/mail/' + domain
+    if os.path.islink(src) or not os.path.isdir(src):
+        return None
+    return sorted(os.listdir(src))
+def read_mail_quotas(etc_dir):
+    """ Mailbox quotas in bytes from a domain's etc/<domain>/quota file """
+    quotas = {}
+    try:
+        with open(etc_dir + '/quota', 'r') as infile:
+            for line in infile:
+                user, sep, limit = line.strip().partition(':')
+                if sep and limit.isdigit():
+                    quotas[user] = int(limit)
+    except IOError:
+        pass
+    return quotas
+def maildir_usage(mailbox):
+    """ (bytes, messages) of a maildir, sized from the S= of message names where present """
+    size = count = 0
+    for root, dirs, names in os.walk(mailbox):
+        if os.path.basename(root) not in ('cur', 'new'):
+            continue
+        for name in names:
+            match = MAILDIR_SIZE_RE.search(name)
+            size += int(match.group(1)) if match else os.lstat(os.path.join(root, name)).st_size
+            count += 1
+    return size, count
+def rebuild_maildirsize(mailbox, quota):
+    """
+    Rewrite a moved mailbox's Dovecot maildirsize from that mailbox alone so
+    its quota usage is right without rescanning the whole account
+    """
+    path = os.path.join(mailbox, 'maildirsize')
+    try:
+        with open(path, 'r') as infile:
+            header = infile.readline().strip()
+    except IOError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        header = None
+    if header is None and quota is None:
+        # no quota to keep, dovecot creates it when it needs one
+        return
+    size, count = maildir_usage(mailbox)
+    atomic_write(path, '{}\n{} {}\n'.format(header or '{}S'.format(quota), size, count))
+    if header is None:
+        st = os.stat(mailbox)
+        os.chown(path, st.st_uid, st.st_gid)
+        os.chmod(path, 0600)
+def move_mail_item(cp_obj, item, quota=None):
+    """
+    Move etc/<domain>, mail/<domain> or a single mail/<domain>/<mailbox>,
+    returns False on errors, which only fail that item
+    """
+    key = 'move_maildir:' + item
+    src = HOME_DIR + cp_obj.fromcp + '/' + item
+    dst = HOME_DIR + cp_obj.tocp + '/' + item
+    if cp_obj.journal.is_done(key) or not is_realpath(cp_obj, src):
+        return True
+    try:
+        journaled_move(cp_obj, key, src, dst)
+        if item.startswith('mail/') and item.count('/') == 2 and \
+           os.path.isdir(dst) and not os.path.islink(dst):
+            rebuild_maildirsize(dst, quota)
+    except (OSError, IOError) as err:
+        logger.error("Error moving {}: \n{}".format(src, os.strerror(err.errno)))
+        return False
+    return True
+def make_mail_dir(cp_obj, domain):
+    """ Create tocp's mail/<domain> like fromcp's for its mailboxes to move into, False on errors """
+    src = HOME_DIR + cp_obj.fromcp + '/mail/' + domain
+    dst = HOME_DIR + cp_obj.tocp + '/mail/' + domain
+    try:
+        if not os.path.isdir(dst):
+            try:
+                os.mkdir(dst)
+            except OSError as err:
+                # another mailbox of the domain got there first
+                if err.errno != errno.EEXIST:
+                    raise
+                return True
+            copy_metadata(src, dst, os.lstat(src))
+    except (OSError, IOError) as err:
+        logger.error("Error creating {}: \n{}".format(dst, os.strerror(err.errno)))
+        return False
+    return True
+def move_mailbox(cp_obj, domain, name):
+    """ Move one mailbox with the quota from tocp's moved etc/<domain>, returns False on errors """
+    if not make_mail_dir(cp_obj, domain):
+        return False
+    quotas = read_mail_quotas(HOME_DIR + cp_obj.tocp + '/etc/' + domain)
+    if not move_mail_item(cp_obj, 'mail/' + domain + '/' + name, quotas.get(name)):
+        return False
+    try:
+        # succeeds once the domain's last mailbox has moved
+        os.rmdir(HOME_DIR + cp_obj.fromcp + '/mail/' + domain)
+    except OSError:
+        pass
+    return True
 def move_maildirs(cp_obj):
-    """ Move the mail directories """
+    """
+    Move the etc/<domain> dirs, then every mailbox of the mail/<domain> dirs
+    on its own, MAIL_WORKERS at a time
+    """
     logger.info("Moving mail directories...")
+    domains = list(cp_obj.domains["addondomains"]) + list(cp_obj.domains["subdomains"]) + \
+              list(cp_obj.domains["main"])
+    # quotas are read from the moved etc dirs
+    results = run_concurrently(lambda domain: move_mail_item(cp_obj, 'etc/' + domain), domains, \
+                               MAIL_WORKERS)
+    items = []
+    for domain in domains:
+        src = HOME_DIR + cp_obj.fromcp + '/mail/' + domain
+        names = mailbox_names(cp_obj, domain) if is_realpath(cp_obj, src) else None
+        if names is None:
+            items.append(('mail/' + domain, None))
+            continue
+        # mailboxes an interrupted run already moved are no longer listed
+        prefix = 'move_maildir:mail/' + domain + '/'
+        names = sorted(set(names).union(key[len(prefix):] for key in cp_obj.journal.keys(prefix)))
+        if not make_mail_dir(cp_obj, domain):
+            results.append(False)
+            continue
+        quotas = read_mail_quotas(HOME_DIR + cp_obj.tocp + '/etc/' + domain)
+        items.extend(('mail/' + domain + '/' + name, quotas.get(name)) for name in names)
+    results += run_concurrently(lambda item: move_mail_item(cp_obj, item[0], item[1]), items, \
+                                MAIL_WORKERS)
+    for domain in domains:
+        src = HOME_DIR + cp_obj.fromcp + '/mail/' + domain
+        if os.path.isdir(src) and not os.path.islink(src):
+            try:
+                os.rmdir(src)
+            except OSError:
+                # a mailbox failed to move, it is logged above
+                pass
+    if not all(results):
+        cp_obj.has_errors = True
+def move_docroot(cp_obj, domain, src, dst):
+    """ Move one domain's docroot into the merge dir, returns False on errors """
     try:
-        for addon in cp_obj.domains["addondomains"]:
-            if is_realpath(cp_obj, '/home/' + cp_obj.fromcp + '/mail/' + addon):
-                shutil.move('/home/' + cp_obj.fromcp + '/mail/' + addon, \
-                            '/home/' + cp_obj.tocp + '/mail/')
-            if is_realpath(cp_obj, '/home/' + cp_obj.fromcp + '/etc/' + addon):
-                shutil.move('/home/' + cp_obj.fromcp + '/etc/' + addon, \
-                            '/home/' + cp_obj.tocp + '/etc/')
-        for subdomain in cp_obj.domains["subdomains"]:
-            if is_realpath(cp_obj, '/home/' + cp_obj.fromcp + '/mail/' + subdomain):
-                shutil.move('/home/' + cp_obj.fromcp + '/mail/' + subdomain, \
-                            '/home/' + cp_obj.tocp + '/mail/')
-            if is_realpath(cp_obj, '/home/' + cp_obj.fromcp + '/etc/' + subdomain):
-                shutil.move('/home/' + cp_obj.fromcp + '/etc/' + subdomain, \
-                            '/home/' + cp_obj.tocp + '/etc/')
-        for domain in cp_obj.domains["main"]:
-            if is_realpath(cp_obj, '/home/' + cp_obj.fromcp + '/mail/' + domain):
-                shutil.move('/home/' + cp_obj.fromcp + '/mail/' + domain, \
-                            '/home/' + cp_obj.tocp + '/mail/')
-            if is_realpath(cp_obj, '/home/' + cp_obj.fromcp + '/etc/' + domain):
-                shutil.move('/home/' + cp_obj.fromcp + '/etc/' + domain, \
-                            '/home/' + cp_obj.tocp + '/etc/')
+        if is_realpath(cp_obj, src):
+            journaled_move(cp_obj, 'move_docroot:' + domain, src, dst)
     except (OSError, IOError) as err:
-        logger.error("Error moving mail directories: \n{}".format(os.strerror(err.errno)))
-        cp_obj.has_errors = True
+        logger.error("Error moving document root: \n{}".format(os.strerror(err.errno)))
+        return False
+    return True
 def move_docroots(cp_obj):
-    """ Move all domains docroots """
+    """ Move all domains docroots to where the path scan mapped them """
+    movers = cp_obj.paths.movers
     for addon in cp_obj.domains["addondomains"]:
+        if movers[addon] != addon:
+            logger.info("Addon docroot for {} moves with {}".format(addon, movers[addon]))
+            continue
         logger.info("Moving addon docroot for {}".format(addon))
         old_docroot = cp_obj.domains["addondomains"][addon]["docroot"]
-        try:
-            if is_realpath(cp_obj, old_docroot):
-                shutil.move(old_docroot, cp_obj.merge_dir)
-        except (OSError, IOError) as err:
-            logger.error("Error moving document root: \n{}".format(os.strerror(err.errno)))
+        if not move_docroot(cp_obj, addon, old_docroot, cp_obj.paths.docroots[addon]):
             cp_obj.has_errors = True
     for subdomain in cp_obj.domains["subdomains"]:
+        if movers[subdomain] != subdomain:
+            logger.info("Subdomain docroot for {} moves with {}".format(subdomain, movers[subdomain]))
+            continue
         logger.info("Moving subdomain docroot for {}".format(subdomain))
         old_docroot = cp_obj.domains["subdomains"][subdomain]
-        try:
-            if is_realpath(cp_obj, old_docroot):
-                shutil.move(old_docroot, cp_obj.merge_dir)
-        except (OSError, IOError) as err:
-            logger.error("Error moving document root: \n{}".format(os.strerror(err.errno)))
+        if not move_docroot(cp_obj, subdomain, old_docroot, cp_obj.paths.docroots[subdomain]):
             cp_obj.has_errors = True
     # move data for fromcp primary domain last otherwise we move all sub/addon dirs too
     for domain in cp_obj.domains["main"]:
         main_docroot = cp_obj.domains["main"][domain]
         logger.info("Moving main docroot {}".format(main_docroot))
-        try:
-            if is_realpath(cp_obj, main_docroot):
-                os.rename(main_docroot, cp_obj.merge_dir + domain)
-        except (OSError, IOError) as err:
-            logger.error("Error moving document root: \n{}".format(os.strerror(err.errno)))
+        if not move_docroot(cp_obj, domain, main_docroot, cp_obj.paths.docroots[domain]):
             cp_obj.has_errors = True
+def del_addon(cp_obj, addon):
+    """ Remove one addon from fromcp, returns True on success """
+    if cp_obj.journal.is_done('del_addon:' + addon):
+        return True
+    logger.info("Deleting addon {}".format(addon))
+    result = cpapi2(cp_obj.fromcp, 'AddonDomain', 'deladdondomain', domain=addon, \
+                    subdomain=cp_obj.domains["addondomains"][addon]["subdomain"])
+    if not result.ok:
+        logger.error("Error deleting addon: \n{}".format(result.output))
+    else:
+        cp_obj.journal.mark('del_addon:' + addon)
+    return result.ok
 def del_addons(cp_obj):
-    """ Loop through and remove addons """
-    for addon in cp_obj.domains["addondomains"]:
-        call_user = '--user=' + cp_obj.fromcp
-        call_domain = 'domain=' + addon
-        call_subdomain = 'subdomain=' + cp_obj.domains["addondomains"][addon]["subdomain"]
-        logger.info("Deleting addon {}".format(addon))
-        proc = subprocess.Popen(['cpapi2', call_user, 'AddonDomain', 'deladdondomain', \
-                                call_domain, call_subdomain], stdout=subprocess.PIPE, \
-                                stderr=subprocess.PIPE)
-        output, err = proc.communicate()
-        if 'result: 1' not in output:
-            logger.error("Error deleting addon: \n{}".format(output))
-            cp_obj.has_errors = True
+    """ Remove fromcp's addons, several at a time """
+    results = run_concurrently(lambda addon: del_addon(cp_obj, addon), \
+                               sorted(cp_obj.domains["addondomains"]))
+    if not all(results):
+        cp_obj.has_errors = True
+def add_addon(cp_obj, addon):
+    """ Add one of fromcp's addons to tocp cpanel, returns True on success """
+    if cp_obj.journal.is_done('add_addon:' + addon):
+        return True
+    new_docroot = cp_obj.paths.docroots[addon]
+    # cpanel requires deleting the subdomain too
+    logger.info("Adding addon {}".format(addon))
+    # remove (tld) to create subdomain
+    result = cpapi2(cp_obj.tocp, 'AddonDomain', 'addaddondomain', dir=new_docroot, \
+                    newdomain=addon, subdomain=addon.split('.', 1)[0])
+    if not result.ok:
+        logger.error("Error adding addon domain: \n{}".format(result.output))
+        cp_obj.failed_domains.add(addon)
+    else:
+        cp_obj.journal.mark('add_addon:' + addon)
+    return result.ok
 def add_addons(cp_obj):
-    """ Add fromcp's addons in loop to tocp cpanel """
-    for addon in cp_obj.domains["addondomains"]:
-        call_user = '--user=' + cp_obj.tocp
-        call_domain = 'newdomain=' + addon
-        # remove (tld) to create subdomain
-        call_subdomain = 'subdomain=' + addon.split('.', 1)[0]
-        new_docroot = cp_obj.merge_dir + \
-                        os.path.basename(os.path.normpath(cp_obj.domains["addondomains"][addon]["docroot"]))
-        call_docroot = 'dir=' + new_docroot
-        # cpanel requires deleting the subdomain too
-        logger.info("Adding addon {}".format(addon))
-        proc = subprocess.Popen(['cpapi2', call_user, 'AddonDomain', 'addaddondomain', \
-                                call_docroot, call_domain, call_subdomain], \
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, err = proc.communicate()
-        if 'result: 1' not in output:
-            logger.error("Error adding addon domain: \n{}".format(output))
-            cp_obj.has_errors = True
+    """ Add fromcp's addons to tocp cpanel, several at a time """
+    results = run_concurrently(lambda addon: add_addon(cp_obj, addon), \
+                               sorted(cp_obj.domains["addondomains"]))
+    if not all(results):
+        cp_obj.has_errors = True
+def add_subdomain(cp_obj, subdomain):
+    """ Add one of fromcp's subdomains to tocp cpanel, returns True on success """
+    if cp_obj.journal.is_done('add_subdomain:' + subdomain):
+        return True
+    rootdomain = subdomain.split('.', 1)[1]
+    if rootdomain in cp_obj.failed_domains:
+        logger.error("Skipping subdomain {}: {} was not added".format(subdomain, rootdomain))
+        cp_obj.failed_domains.add(subdomain)
+        return False
+    new_docroot = cp_obj.paths.docroots[subdomain]
+    logger.info("Adding subdomain {}".format(subdomain))
+    result = cpapi2(cp_obj.tocp, 'SubDomain', 'addsubdomain', domain=subdomain.split('.', 1)[0], \
+                    rootdomain=rootdomain, dir=new_docroot, disallowdot=1)
+    if not result.ok:
+        logger.error("Error adding subdomain: \n{}".format(result.output))
+        cp_obj.failed_domains.add(subdomain)
+    else:
+        cp_obj.journal.mark('add_subdomain:' + subdomain)
+    return result.ok
+def subdomain_waves(subdomains):
+    """
+    Order subdomains into waves that can be added concurrently
+    A subdomain of another subdomain (a.b.example.com) waits for the wave adding its root
+    """
+    waves = []
+    remaining = set(subdomains)
+    while remaining:
+        wave = sorted(sub for sub in remaining if sub.split('.', 1)[1] not in remaining)
+        waves.append(wave)
+        remaining.difference_update(wave)
+    return waves
 def add_subdomains(cp_obj):
-    """ Add fromcp's subdomains in loop to tocp cpanel """
-    for subdomain in cp_obj.domains["subdomains"]:
-        call_user = '--user=' + cp_obj.tocp
-        call_domain = 'domain=' + subdomain.split('.', 1)[0]
-        call_rootdomain = 'rootdomain=' + subdomain.split('.', 1)[1]
-        new_docroot = cp_obj.merge_dir + \
-                        os.path.basename(os.path.normpath(cp_obj.domains["subdomains"][subdomain]))
-        call_docroot = 'dir=' + new_docroot
-        logger.info("Adding subdomain {}".format(subdomain))
-        proc = subprocess.Popen(['cpapi2', call_user, 'SubDomain', 'addsubdomain', call_domain, \
-                                call_rootdomain, call_docroot, 'disallowdot=1'], \
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, err = proc.communicate()
-        if 'result: 1' not in output:
-            logger.error("Error adding subdomain: \n{}".format(output))
+    """ Add fromcp's subdomains to tocp cpanel once their root domain exists """
+    for wave in subdomain_waves(cp_obj.domains["subdomains"]):
+        results = run_concurrently(lambda subdomain: add_subdomain(cp_obj, subdomain), wave)
+        if not all(results):
             cp_obj.has_errors = True
+def load_db_metadata(user):
+    """ Load a user's database json and grants yaml, returns (json, grants) """
+    with open(DATABASES_DIR + user + '.json', 'r') as infile:
+        db_json = json.load(infile)
+    with open(DATABASES_DIR + 'grants_' + user + '.yaml', 'r') as stream:
+        grants = yaml_load(stream) or {}
+    return db_json, grants
+def merge_db_metadata(cp_obj, engines, from_json, from_grants, to_json, to_grants):
+    """ Merge fromcp's dbs, db users and grants for engines into tocp's in memory """
+    for engine in engines:
+        engine_json = to_json.setdefault(engine, {})
+        # check if the engine is empty because cpanel
+        if 'dbusers' not in engine_json:
+            logger.info("Empty {} json updating...".format(engine))
+            engine_json.update({'dbs':{}, 'dbusers':{}, 'noprefix':{}, 'owner':"", 'server':""})
+        engine_json['dbusers'].update(from_json[engine]['dbusers'])
+        engine_json['dbs'].update(from_json[engine]['dbs'])
+        engine_grants = (from_grants.get(engine) or {}).get(cp_obj.fromcp) or {}
+        to_grants.setdefault(engine, {}).setdefault(cp_obj.tocp, {}).update(engine_grants)
 def reassign_dbs(cp_obj):
-    """ Assign fromcp's mysql dbs, users, and grants to the tocp cpanel """
+    """
+    Assign fromcp's mysql/pgsql dbs, users, and grants to the tocp cpanel
+    every metadata file is read once and tocp's are replaced atomically
+    """
     logger.info("Assigning databases and users to tocp cpanel...")
-    call_user = '--user=' + cp_obj.fromcp
-    mysql_fail = False
-    pgsql_fail = False
-    proc = subprocess.Popen(['cpapi2', call_user, 'MysqlFE', 'listdbs', '--output=json'], \
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    json_output, err = proc.communicate()
-    try:
-        json_mysql = json.loads(json_output)
-    except ValueError as err:
-        logger.error("Decoding mysql json failed: \n{}".format(err))
-        mysql_fail = True
-    proc = subprocess.Popen(['cpapi2', call_user, 'Postgres', 'listdbs', '--output=json'], \
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    json_output, err = proc.communicate()
-    try:
-        json_pgsql = json.loads(json_output)
-    except ValueError as err:
-        logger.error("Decoding pgsql json failed: \n{}".format(err))
-        pgsql_fail = True
+    databases = INVENTORY.databases(cp_obj.fromcp)
     # if both are unreadable don't continue
-    if mysql_fail and pgsql_fail:
+    if databases['MYSQL'] is None and databases['PGSQL'] is None:
+        return
+    engines = [engine for engine in ('MYSQL', 'PGSQL') if databases[engine]]
+    if not engines:
+        logger.info("No databases found.")
         return
+    db_dir = DATABASES_DIR
     # address edge cases missing grant files
-    if not os.path.isfile('/var/cpanel/userdata/grants_' + cp_obj.tocp + '.yaml'):
-        proc = subprocess.Popen(['/usr/local/cpanel/bin/dbstoregrants', cp_obj.tocp], \
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, err = proc.communicate()
-    if not os.path.isfile('/var/cpanel/userdata/grants_' + cp_obj.fromcp + '.yaml'):
-        proc = subprocess.Popen(['/usr/local/cpanel/bin/dbstoregrants', cp_obj.tocp], \
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, err = proc.communicate()
+    for user in (cp_obj.tocp, cp_obj.fromcp):
+        if not os.path.isfile(db_dir + 'grants_' + user + '.yaml'):
+            try:
+                output, err = run_script(['/usr/local/cpanel/bin/dbstoregrants', user])
+            except OSError as err:
+                logger.error("Error storing grants of {}: {}".format(user, os.strerror(err.errno)))
+                cp_obj.has_errors = True
+                return
     try:
-        if not mysql_fail:
-            has_mysql_dbs = json_mysql["cpanelresult"]["data"]
-        if not pgsql_fail:
-            has_pgsql_dbs = json_pgsql["cpanelresult"]["data"]
-    except IndexError as err:
+        from_json, from_grants = load_db_metadata(cp_obj.fromcp)
+        to_json, to_grants = load_db_metadata(cp_obj.tocp)
+        merge_db_metadata(cp_obj, engines, from_json, from_grants, to_json, to_grants)
+        json_data = json.dumps(to_json)
+        yaml_data = yaml_dump(to_grants)
+    except IOError as err:
+        logger.error("Database json/yaml file open error:\n{}".format(os.strerror(err.errno)))
+        cp_obj.has_errors = True
+        return
+    except (ValueError, KeyError, TypeError, AttributeError, yaml.YAMLError) as err:
         logger.error("Database reassignment failed!\n{}".format(str(err)))
         cp_obj.has_errors = True
-    else:
-        # Check for mysql dbs
-        if has_mysql_dbs or has_pgsql_dbs:
-            try:
-                with open('/var/cpanel/databases/' + cp_obj.fromcp + '.json', 'r') as infile:
-                    fromcp_json = json.load(infile)
-                    infile.close
-                    try:
-                        if has_mysql_dbs:
-                            fromcp_mysql_dbs = fromcp_json['MYSQL']['dbs']
-                            fromcp_mysql_dbusers = fromcp_json['MYSQL']['dbusers']
-                        if has_pgsql_dbs:
-                            fromcp_pgsql_dbs = fromcp_json['PGSQL']['dbs']
-                            fromcp_pgsql_dbusers = fromcp_json['PGSQL']['dbusers']
-                    except IndexError as err:
-                        logger.error("Database reassignment failed!\n{}".format(str(err)))
-                        cp_obj.has_errors = True
-                    else:
-                        with open('/var/cpanel/databases/' + cp_obj.tocp + '.json', 'r') as infile:
-                            tocp_json = json.load(infile)
-                            infile.close
-                            # check if pgsql is empty because cpanel
-                            if 'dbusers' not in tocp_json['PGSQL']:
-                                logger.info("Empty PGSQL json updating...")
-                                pgsql_dict = {'dbs':{}, 'dbusers':{}, 'noprefix':{}, 'owner':"", 'server':""}
-                                tocp_json['PGSQL'].update(pgsql_dict)
-                            try:
-                                if has_mysql_dbs:
-                                    tocp_json['MYSQL']['dbusers'].update(fromcp_mysql_dbusers)
-                                    tocp_json['MYSQL']['dbs'].update(fromcp_mysql_dbs)
-                                if has_pgsql_dbs:
-                                    tocp_json['PGSQL']['dbusers'].update(fromcp_pgsql_dbusers)
-                                    tocp_json['PGSQL']['dbs'].update(fromcp_pgsql_dbs)
-                            except IndexError as err:
-                                logger.error("Database reassignment failed!\n{}".format(str(err)))
-                                cp_obj.has_errors = True
-                            else:
-                                with open('/var/cpanel/databases/' + cp_obj.tocp + '.json', 'w') as outfile:
-                                    json.dump(tocp_json, outfile)
-                                    outfile.close()
-                                # made it this far, update database grant files
-                                with open('/var/cpanel/databases/grants_' + cp_obj.fromcp + '.yaml', 'r') as stream:
-                                    try:
-                                        fromcp_yaml = yaml.safe_load(stream)
-                                        if has_mysql_dbs:
-                                            fromcp_mysql_grants = fromcp_yaml['MYSQL'][cp_obj.fromcp]
-                                        if has_pgsql_dbs:
-                                            fromcp_pgsql_grants = fromcp_yaml['PGSQL'][cp_obj.fromcp]
-                                    except yaml.YAMLError as err:
-                                        logger.error(str(err))
-                                    else:
-                                        with open('/var/cpanel/databases/grants_' + cp_obj.tocp + '.yaml', 'r') as stream:
-                                            try:
-                                                tocp_yaml = yaml.safe_load(stream)
-                                                if has_mysql_dbs:
-                                                    tocp_yaml['MYSQL'][cp_obj.tocp].update(fromcp_mysql_grants)
-                                                if has_pgsql_dbs:
-                                                    tocp_yaml['PGSQL'][cp_obj.tocp].update(fromcp_pgsql_grants)
-                                            except yaml.YAMLError as err:
-                                                logger.error(str(err))
-                                            else:
-                                                with open('/var/cpanel/databases/grants_' + cp_obj.tocp + '.yaml', 'w') as yamlfile:
-                                                    yaml.safe_dump(tocp_yaml, yamlfile, default_flow_style=False)
-                                                # Move db files out of the way so removeacct won't remove db users
-                                                if os.path.isfile('/var/cpanel/databases/grants_' + cp_obj.fromcp + '.yaml'):
-                                                    shutil.move('/var/cpanel/databases/grants_' + cp_obj.fromcp + '.yaml', \
-                                                                '/var/cpanel/databases/grants_' + cp_obj.fromcp + '-' + \
-                                                                time.strftime("%Y%m%d-%H%M%S"))
-                                                if os.path.isfile('/var/cpanel/databases/' + cp_obj.fromcp + '.json'):
-                                                    shutil.move('/var/cpanel/databases/' + cp_obj.fromcp + '.json', \
-                                                                '/var/cpanel/databases/' + cp_obj.fromcp + '.json' + \
-                                                                '-' + time.strftime("%Y%m%d-%H%M%S"))
-            except IOError as err:
-                logger.error("Database json/yaml file open error:\n{}".format(os.strerror(err.errno)))
-                cp_obj.has_errors = True
-        else:
-            logger.info("No databases found.")
+        return
+    try:
+        # both files are serialized before either is replaced
+        atomic_write(db_dir + cp_obj.tocp + '.json', json_data)
+        atomic_write(db_dir + 'grants_' + cp_obj.tocp + '.yaml', yaml_data)
+        # Move db files out of the way so removeacct won't remove db users
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        os.rename(db_dir + 'grants_' + cp_obj.fromcp + '.yaml', \
+                  db_dir + 'grants_' + cp_obj.fromcp + '-' + stamp)
+        os.rename(db_dir + cp_obj.fromcp + '.json', db_dir + cp_obj.fromcp + '.json' + '-' + stamp)
+    except (IOError, OSError) as err:
+        logger.error("Database json/yaml file write error:\n{}".format(os.strerror(err.errno)))
+        cp_obj.has_errors = True
 def is_confirmed(cp_obj):
     """ Confirm primary cpanel and cpanel to be merged """
     while "invalid input":
@@ -303,150 +1287,1876 @@ def is_confirmed(cp_obj):
         if reply[:1] == 'n':
             return False
 def is_realpath(cp_obj, path):
-    home_path = '/home/' + cp_obj.fromcp
-    lepath = os.path.realpath(path)
-    return lepath.startswith(home_path)
-def backupdns(cp_obj):
-    """ Make a backup of DNS since removing addons removes DNS """
+    """ Check path resolves to somewhere inside fromcp's home dir """
+    return cp_obj.paths.is_inside(path)
+def set_snapshot_dir(path):
+    """ Change where config snapshots are kept """
+    global SNAPSHOT_DIR
+    SNAPSHOT_DIR = path
+def snapshot_paths(cp_obj):
+    """
+    Config files a merge of cp_obj may change, returns (files, dirs)
+    every file under dirs is snapshotted, files created there later are removed on rollback
+    """
+    files = set()
+    tocp_domains = INVENTORY.domains(cp_obj.tocp) or {}
+    for domain_dict in (cp_obj.domains, tocp_domains):
+        for kind in ('main', 'addondomains', 'parked'):
+            for domain in domain_dict.get(kind) or {}:
+                files.add(NAMED_DIR + domain + '.db')
+    dirs = []
+    for user in (cp_obj.tocp, cp_obj.fromcp):
+        # modifyacct rewrites the users file for the quotas and the main domain rename
+        files.add(USERS_DIR + user)
+        files.add(DATABASES_DIR + user + '.json')
+        files.add(DATABASES_DIR + 'grants_' + user + '.yaml')
+        dirs.append(USERDATA_DIR + user)
+    return sorted(files), dirs
+def load_snapshot_index():
+    """ sha256 of every stored blob: archive holding it """
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, 'index.json'), 'r') as infile:
+            return json.load(infile)
+    except (IOError, ValueError):
+        return {}
+def add_tar_data(tar, name, data):
+    """ Stream data into tar as a regular file member """
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    info.mode = 0600
+    tar.addfile(info, io.BytesIO(data))
+class DigestReader:
+    """ File wrapper hashing what is read through it """
+    def __init__(self, infile):
+        self.infile = infile
+        self.digest = hashlib.sha256()
+    def read(self, size=-1):
+        data = self.infile.read(size)
+        self.digest.update(data)
+        return data
+def add_tar_file(tar, name, path, size, digest):
+    """ Stream a file into tar as name, checking it still has the digest it was indexed with """
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = time.time()
+    info.mode = 0600
+    with open(path, 'rb') as infile:
+        reader = DigestReader(infile)
+        tar.addfile(info, reader)
+    if reader.digest.hexdigest() != digest:
+        raise IOError(errno.EIO, "{} changed while it was snapshotted".format(path))
+def take_snapshot(cp_obj):
+    """
+    Write one gzip'd tar holding a manifest.json and, content addressed as
+    blobs/<sha256>, every snapshotted file not already stored by an earlier
+    snapshot. Returns the archive's path
+    """
+    files, dirs = snapshot_paths(cp_obj)
+    listings = {}
+    for top in dirs:
+        listing = []
+        for root, subdirs, names in os.walk(top):
+            for name in names:
+                path = os.path.join(root, name)
+                if stat.S_ISREG(os.lstat(path).st_mode):
+                    listing.append(path)
+        listings[top] = sorted(listing)
+        files.extend(listing)
+    with SNAPSHOT_LOCK:
+        if not os.path.isdir(SNAPSHOT_DIR):
+            os.makedirs(SNAPSHOT_DIR, 0700)
+        index = load_snapshot_index()
+        name = '{}-{}-{}.tar.gz'.format(cp_obj.tocp, cp_obj.fromcp, time.strftime("%Y%m%d-%H%M%S"))
+        entries = {}
+        blobs = {} # digest: (path, size) of the files streamed into this archive
+        for path in files:
+            try:
+                st = os.stat(path)
+                digest = file_digest(path)
+            except (IOError, OSError) as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                # didn't exist before the merge, rollback removes it
+                entries[path] = {'absent': True}
+                continue
+            archive = index.get(digest)
+            if digest in blobs or archive is None or \
+               not os.path.isfile(os.path.join(SNAPSHOT_DIR, archive)):
+                blobs.setdefault(digest, (path, st.st_size))
+                archive = name
+            entries[path] = {'sha256': digest, 'archive': archive, 'mode': stat.S_IMODE(st.st_mode), \
+                             'uid': st.st_uid, 'gid': st.st_gid, 'mtime': st.st_mtime}
+        manifest = {'tocp': cp_obj.tocp, 'fromcp': cp_obj.fromcp, 'merge_dir': cp_obj.merge_dir, \
+                    'created': time.time(), 'files': entries, 'dirs': listings}
+        path = os.path.join(SNAPSHOT_DIR, name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as outfile:
+            tar = tarfile.open(fileobj=outfile, mode='w|gz')
+            # the manifest goes first so rollback reads it before any blob
+            add_tar_data(tar, 'manifest.json', json.dumps(manifest, sort_keys=True))
+            # one file at a time, hashed again as it streams in
+            for digest in sorted(blobs):
+                add_tar_file(tar, 'blobs/' + digest, blobs[digest][0], blobs[digest][1], digest)
+            tar.close()
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.rename(tmp_path, path)
+        for digest in blobs:
+            index[digest] = name
+        atomic_write(os.path.join(SNAPSHOT_DIR, 'index.json'), json.dumps(index, sort_keys=True))
+    logger.info("Snapshotted {} config files, {} new blobs".format(len(entries), len(blobs)))
+    return path
+def snapshot_configs(cp_obj):
+    """ Snapshot the zones, userdata and database files the merge may change """
+    try:
+        path = take_snapshot(cp_obj)
+    except (IOError, OSError, tarfile.TarError) as err:
+        logger.error("Error taking config snapshot: \n{}".format(err))
+        cp_obj.has_errors = True
+        return
+    logger.info("Config snapshot written to {}".format(path))
+def find_snapshot(tocp, fromcp):
+    """ Newest snapshot archive of merging fromcp into tocp, or None """
+    prefix = '{}-{}-'.format(tocp, fromcp)
+    try:
+        names = [name for name in os.listdir(SNAPSHOT_DIR) \
+                 if name.startswith(prefix) and name.endswith('.tar.gz')]
+    except OSError:
+        return None
+    if not names:
+        return None
+    return os.path.join(SNAPSHOT_DIR, max(names))
+def restore_file(path, entry, data):
+    """ Put a snapshotted file back with its mode, owner and mtime """
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    atomic_write(path, data)
+    os.chmod(path, entry['mode'])
+    os.chown(path, entry['uid'], entry['gid'])
+    os.utime(path, (entry['mtime'], entry['mtime']))
+def read_blobs(tar, wanted, entries, handle):
+    """ Stream through tar once handing every wanted blob to handle, returns the digests read """
+    found = set()
+    for member in tar:
+        digest = member.name[len('blobs/'):]
+        if not member.name.startswith('blobs/') or digest not in wanted:
+            continue
+        data = tar.extractfile(member).read()
+        for path in wanted[digest]:
+            handle(path, entries[path], data)
+        found.add(digest)
+    return found
+def read_snapshot(archive_path, handle, paths=None):
+    """
+    Call handle(path, entry, data) for every file of a snapshot, or only those
+    in paths, reading each archive holding their blobs in a single pass
+    returns (manifest, digests missing from the archives)
+    """
+    with open(archive_path, 'rb') as infile:
+        tar = tarfile.open(fileobj=infile, mode='r|gz')
+        member = tar.next()
+        if member is None or member.name != 'manifest.json':
+            raise ValueError("{} has no manifest".format(archive_path))
+        manifest = json.loads(tar.extractfile(member).read())
+        entries = manifest['files']
+        # archive: sha256: paths holding that content
+        wanted = defaultdict(lambda: defaultdict(list))
+        for path, entry in entries.items():
+            if not entry.get('absent') and (paths is None or path in paths):
+                wanted[entry['archive']][entry['sha256']].append(path)
+        own = os.path.basename(archive_path)
+        missing = set(wanted[own]) - read_blobs(tar, wanted[own], entries, handle)
+        tar.close()
+    for archive in sorted(wanted):
+        if archive == own:
+            continue
+        with open(os.path.join(os.path.dirname(archive_path), archive), 'rb') as infile:
+            tar = tarfile.open(fileobj=infile, mode='r|gz')
+            missing.update(set(wanted[archive]) - read_blobs(tar, wanted[archive], entries, handle))
+            tar.close()
+    return manifest, missing
+def rollback(archive_path):
+    """ Restore every config file in a snapshot, returns True without errors """
+    logger.info("Rolling back config files from {}...".format(archive_path))
+    try:
+        manifest, missing = read_snapshot(archive_path, restore_file)
+        entries = manifest['files']
+        # files the merge created
+        created = [path for path, entry in entries.items() if entry.get('absent')]
+        for top, listing in manifest['dirs'].items():
+            kept = set(listing)
+            for root, subdirs, names in os.walk(top):
+                created.extend(os.path.join(root, name) for name in names \
+                               if os.path.join(root, name) not in kept)
+        removed = [path for path in created if os.path.lexists(path)]
+        for path in removed:
+            os.remove(path)
+    except (IOError, OSError, ValueError, KeyError, tarfile.TarError) as err:
+        logger.error("Rollback from {} failed: \n{}".format(archive_path, err))
+        return False
+    if missing:
+        logger.error("Rollback incomplete: {} blobs missing from the snapshot archives".format(len(missing)))
+        return False
+    logger.info("Restored {} files and removed {} from {}".format(len(entries) - \
+                len([path for path, entry in entries.items() if entry.get('absent')]), \
+                len(removed), archive_path))
+    return True
+def zone_serial(text):
+    """ SOA serial of a zone file's text, None when it has none """
+    match = ZONE_SERIAL_RE.search(text)
+    return int(match.group(2)) if match else None
+def restamp_zone(text, newer_than=None):
+    """ Zone text with its SOA serial raised past its own and newer_than so secondaries reload it """
+    serial = zone_serial(text)
+    if serial is None:
+        return text
+    serial = max(serial + 1, (newer_than or 0) + 1, int(time.strftime("%Y%m%d00")))
+    return ZONE_SERIAL_RE.sub(lambda match: match.group(1) + str(serial), text, 1)
+def restore_zones(cp_obj):
+    """
+    Put back the zones cPanel deleted and recreated for fromcp's addons and
+    main domain as they were before the merge, from its snapshot. The files
+    are written directly, so named is reloaded once more on top of cPanel's
+    per domain reloads and a DNS cluster is synced with synczones
+    """
+    logger.info("Restoring DNS zones...")
+    domains = [domain for domain in list(cp_obj.domains["addondomains"]) + list(cp_obj.domains["main"]) \
+               if domain not in cp_obj.failed_domains]
+    archive = find_snapshot(cp_obj.tocp, cp_obj.fromcp)
+    if archive is None:
+        logger.error("Unable to restore zones: no snapshot of the merge found")
+        cp_obj.has_errors = True
+        return
+    zones = {}
+    def keep(path, entry, data):
+        zones[path] = (entry, data)
+    try:
+        manifest, missing = read_snapshot(archive, keep, set(NAMED_DIR + domain + '.db' for domain in domains))
+    except (IOError, OSError, ValueError, KeyError, tarfile.TarError) as err:
+        logger.error("Unable to read zones from {}: \n{}".format(archive, err))
+        cp_obj.has_errors = True
+        return
+    if missing:
+        logger.error("{} zones are missing from the snapshot archives".format(len(missing)))
+        cp_obj.has_errors = True
+    for path, (entry, data) in sorted(zones.items()):
+        try:
+            try:
+                with open(path, 'r') as infile:
+                    current = zone_serial(infile.read())
+                existed = True
+            except IOError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                current = None
+                existed = False
+            atomic_write(path, restamp_zone(data, current))
+            if not existed:
+                os.chown(path, entry['uid'], entry['gid'])
+                os.chmod(path, entry['mode'])
+        except (IOError, OSError) as err:
+            logger.error("Error restoring zone {}: \n{}".format(path, os.strerror(err.errno)))
+            cp_obj.has_errors = True
+    if not zones:
+        return
+    logger.info("Restored {} zones, reloading named".format(len(zones)))
     try:
-        for addon in cp_obj.domains["addondomains"]:
-            dns_path = '/var/named/' + addon + '.db'
-            if os.path.isfile(dns_path):
-                shutil.copy2(dns_path, dns_path + '_' + time.strftime("%Y%m%d-%H%M%S"))
-        for domain in cp_obj.domains["main"]:
-            dns_path = '/var/named/' + domain + '.db'
-            if os.path.isfile(dns_path):
-                shutil.copy2(dns_path, dns_path + '_' + time.strftime("%Y%m%d-%H%M%S"))
+        output, err = run_script(DNS_RELOAD_COMMAND)
     except OSError as err:
-        logger.error("Error backing up DNS: \n{}".format(os.strerror(err.errno)))
+        err = os.strerror(err.errno)
+    if err:
+        logger.error("Error reloading named: \n{}".format(err))
+        cp_obj.has_errors = True
+    if os.path.exists(ROOT + DNS_CLUSTER_FLAG):
+        # writing the files bypasses dnsadmin, the peers still have cPanel's default zones
+        logger.info("Syncing the restored zones to the DNS cluster")
+        result = whmapi1('synczones')
+        if not result.ok:
+            logger.error("Error syncing zones to the DNS cluster: \n{} \n{}".format(result.output, result.err))
+            cp_obj.has_errors = True
+def is_rollback_confirmed(archives):
+    """ Confirm restoring config files from each snapshot with a single prompt """
+    print "Requesting to roll back {} merges from their snapshots:".format(len(archives))
+    for archive in archives:
+        print "    {}".format(archive)
+    while "invalid input":
+        reply = str(raw_input('Overwrite the current zone, userdata and database files ' + \
+                    'with the snapshotted ones? (y/n): ')).lower().strip()
+        if reply[:1] == 'y':
+            return True
+        if reply[:1] == 'n':
+            return False
+def rollback_archives(pairs):
+    """ The newest snapshot of each pair, last merge first """
+    archives = []
+    for tocp, fromcp in reversed(pairs):
+        archive = find_snapshot(tocp, fromcp)
+        if archive is None:
+            raise MergeError("Unable to roll back: no snapshot of {} into {} in {}".format(fromcp, tocp, \
+                     SNAPSHOT_DIR))
+        archives.append(archive)
+    return archives
+def rollback_pairs(pairs):
+    """ Roll back the newest snapshot of each pair, last merge first, returns True without errors """
+    return all([rollback(path) for path in rollback_archives(pairs)])
+def setup_logging_console(tag_merges=False):
+    """ Create the console log, shared by every merge in a batch """
+    logger.setLevel(logging.DEBUG)
+    if not any(type(handler) is logging.StreamHandler for handler in logger.handlers):
+        c_handler = logging.StreamHandler()
+        c_handler.setLevel(logging.INFO)
+        c_format = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+        if tag_merges:
+            # parallel merges interleave on the console, prefix each line with its merge
+            c_handler.addFilter(MergeLogFilter())
+            c_format = logging.Formatter('%(name)s - %(levelname)s - [%(merge)s] %(message)s')
+        c_handler.setFormatter(c_format)
+        logger.addHandler(c_handler)
+def make_imh_dir(cp_obj):
+    """ Create tocp's .imh dir holding the merge log and journal """
+    imh_dir = HOME_DIR + cp_obj.tocp + '/.imh'
+    if not os.path.isdir(imh_dir):
+        os.makedirs(imh_dir)
+        os.chown(imh_dir, cp_obj.uid, cp_obj.gid)
+    return imh_dir
 def setup_logging(cp_obj, name):
     """ Create log """
-    logdir = '/home/' + cp_obj.tocp + '/.imh'
-    logfile = '/home/' + cp_obj.tocp + '/.imh/cpmerge.log'
-    if not os.path.isdir(logdir):
-        os.makedirs(logdir)
-        os.chown(logdir, cp_obj.uid, cp_obj.gid)
-    logger.setLevel(logging.DEBUG)
+    logfile = make_imh_dir(cp_obj) + '/cpmerge.log'
+    setup_logging_console()
+    f_handler = None
     try:
         # Create handlers
-        c_handler = logging.StreamHandler()
         f_handler = logging.FileHandler(logfile)
-        c_handler.setLevel(logging.INFO)
         f_handler.setLevel(logging.DEBUG)
+        # only this merge's records, other merges running in parallel have their own log
+        set_merge_context(cp_obj.tocp, cp_obj.fromcp)
+        f_handler.addFilter(MergeLogFilter(_merge_context.merge))
         # Create formatters and add it to handlers
-        c_format = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
         f_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        c_handler.setFormatter(c_format)
         f_handler.setFormatter(f_format)
         # Add handlers to the logger
-        logger.addHandler(c_handler)
         logger.addHandler(f_handler)
     except Exception as e:
         logger.warning("Failed to open logfile: %s", str(e))
+    return f_handler
+def teardown_logging(f_handler):
+    """ Detach a merge's logfile so the next merge in a batch gets its own """
+    if f_handler is not None:
+        logger.removeHandler(f_handler)
+        f_handler.close()
+def can_access_api():
+    """ Test WHMAPI access """
+    if not whmapi1('version').ok:
+        raise MergeError("Cannot access WHMAPI")
+class MergeError(Exception):
+    """ A merge, plan or rollback can't start or continue """
+class Journal:
+    """
+    Append only record of a merge's progress, one json line per event, so an
+    interrupted merge can be resumed. The first line stores the merge dir and
+    the domains fromcp had when the merge started, each later line the state
+    of one operation: started, copied (moves only) or done
+    """
+    def __init__(self, path=None):
+        self.path = path # None keeps the journal in memory only
+        self.header = None
+        self.states = {}
+        self.finished = False
+        self.lock = threading.Lock()
+        if path is not None and os.path.isfile(path):
+            self.load()
+    def load(self):
+        with open(self.path, 'r') as infile:
+            for line in infile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line may be torn if the merge was killed mid write
+                    continue
+                if 'merge_dir' in record:
+                    self.header = record
+                elif record.get('finished'):
+                    self.finished = True
+                else:
+                    self.states[record['key']] = record['state']
+    def append(self, record, mode='a'):
+        """ Durably add a line to the journal """
+        with self.lock:
+            if self.path is None:
+                return
+            with open(self.path, mode) as outfile:
+                outfile.write(json.dumps(record, sort_keys=True) + '\n')
+                outfile.flush()
+                os.fsync(outfile.fileno())
+    def start(self, cp_obj):
+        """ Begin a new journal for cp_obj, replacing any finished one """
+        self.header = {'tocp': cp_obj.tocp, 'fromcp': cp_obj.fromcp, 'merge_dir': cp_obj.merge_dir, \
+                       'domains': cp_obj.domains, 'started': time.strftime("%Y%m%d-%H%M%S")}
+        self.states = {}
+        self.finished = False
+        self.append(self.header, 'w')
+    def state(self, key):
+        return self.states.get(key)
+    def is_done(self, key):
+        return self.states.get(key) == 'done'
+    def keys(self, prefix):
+        """ Keys with a recorded state that start with prefix """
+        return [key for key in self.states if key.startswith(prefix)]
+    def mark(self, key, state='done'):
+        """ Record an operation reaching state """
+        self.states[key] = state
+        self.append({'key': key, 'state': state, 'time': time.time()})
+    def finish(self):
+        self.finished = True
+        self.append({'finished': True, 'time': time.time()})
+    def discard(self):
+        """ Remove the journal, a new merge of the pair starts from scratch """
+        with self.lock:
+            if self.path is not None and os.path.lexists(self.path):
+                os.unlink(self.path)
+            self.header = None
+            self.states = {}
+def journal_path(tocp, fromcp):
+    """ Where the journal of merging fromcp into tocp is kept, out of tocp's reach """
+    return STATE_DIR + tocp + '-' + fromcp + '.journal'
+def run_once(cp_obj, key, step):
+    """
+    Run a whole step unless the journal has it done, it is done if it logs no
+    errors, steps in GRAPH_ALWAYS_STEPS cover what ran before them and are
+    only done if that had no errors either, a resume reruns them for the rest
+    """
+    if cp_obj.journal.is_done(key):
+        logger.info("Skipping {}: already done".format(key))
+        return
+    had_errors = cp_obj.has_errors
+    cp_obj.has_errors = False
+    step(cp_obj)
+    if not cp_obj.has_errors and not (had_errors and key.split(':', 1)[0] in GRAPH_ALWAYS_STEPS):
+        cp_obj.journal.mark(key)
+    cp_obj.has_errors = cp_obj.has_errors or had_errors
+def load_userdata_domains(user):
+    """
+    Read a user's domains straight from /var/cpanel/userdata
+    returns (domains, files read) or None if the userdata can't be used
+    """
+    base = USERDATA_DIR + user
+    files = [base, base + '/main']
+    def vhost(domain):
+        files.append(base + '/' + domain)
+        with open(base + '/' + domain, 'r') as infile:
+            return yaml_load(infile)
+    domain_dict = defaultdict(dict)
+    try:
+        with open(base + '/main', 'r') as infile:
+            main = yaml_load(infile)
+        addons = main.get('addon_domains') or {}
+        for addon, subdomain in addons.items():
+            data = vhost(subdomain)
+            domain_dict["addondomains"][addon] = {"docroot": data["documentroot"], \
+                                                  "subdomain": data["servername"]}
+        # every addon is backed by a subdomain that isn't merged on its own
+        for subdomain in main.get('sub_domains') or []:
+            if subdomain not in addons.values():
+                domain_dict["subdomains"][subdomain] = vhost(subdomain)["documentroot"]
+        data = vhost(main['main_domain'])
+        domain_dict["main"][data["servername"]] = data["documentroot"]
+        for domain in main.get('parked_domains') or []:
+            domain_dict["parked"][domain] = data["documentroot"]
+    except (IOError, OSError, KeyError, TypeError, AttributeError, yaml.YAMLError):
+        return None
+    return domain_dict, files
+def load_api_domains(user):
+    """ Get a user's domains from UAPI, returns (domains, []) or None """
+    domain_dict = defaultdict(dict)
+    json_domains = uapi(user, 'DomainInfo', 'domains_data').data
+    try:
+        for dom in json_domains["sub_domains"]:
+            subdomain = dom["domain"]
+            docroot = dom["documentroot"]
+            domain_dict["subdomains"][subdomain] = docroot
+        for dom in json_domains["addon_domains"]:
+            addon = dom["domain"]
+            docroot = dom["documentroot"]
+            subdomain = dom["servername"]
+            domain_dict["addondomains"][addon] = {"docroot": docroot, "subdomain": subdomain}
+        domain = json_domains["main_domain"]["servername"]
+        docroot = json_domains["main_domain"]["documentroot"]
+        domain_dict["main"][domain] = docroot
+        for domain in json_domains.get("parked_domains", []):
+            domain_dict["parked"][domain] = docroot
+    except (IndexError, KeyError, TypeError) as err:
+        logger.error("Error parsing {}'s domains: {}".format(user, err))
+        return None
+    return domain_dict, []
+def load_databases(user):
+    """ Names of a user's MYSQL and PGSQL databases, an engine is None if it can't be read """
+    path = DATABASES_DIR + user + '.json'
+    try:
+        with open(path, 'r') as infile:
+            db_json = json.load(infile)
+        return dict((engine, sorted((db_json.get(engine) or {}).get('dbs') or {})) \
+                    for engine in ('MYSQL', 'PGSQL')), [path]
+    except (IOError, ValueError, AttributeError):
+        pass
+    databases = {}
+    for engine, module in (('MYSQL', 'MysqlFE'), ('PGSQL', 'Postgres')):
+        result = cpapi2(user, module, 'listdbs')
+        if result.data is None:
+            logger.error("Decoding {} json failed: \n{}".format(engine.lower(), result.output))
+            databases[engine] = None
+        else:
+            databases[engine] = [db.get('db') for db in result.data]
+    return databases, []
+def get_user_ids(user):
+    """ (uid, gid) of user, from the passwd file under ROOT when one is set """
+    if not ROOT:
+        entry = pwd.getpwnam(user)
+        return entry.pw_uid, entry.pw_gid
+    try:
+        with open(ROOT + '/etc/passwd', 'r') as infile:
+            for line in infile:
+                fields = line.split(':')
+                if len(fields) > 3 and fields[0] == user:
+                    return int(fields[2]), int(fields[3])
+    except IOError:
+        pass
+    raise KeyError(user)
+def file_mtimes(paths):
+    """ mtimes of paths, None for missing ones """
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+class Inventory:
+    """
+    Cache of account data shared by every merge in a run: domains, uid/gid and
+    database lists. Data read from files is reloaded when their mtimes change,
+    data from the API is kept until invalidate() is called for the user
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache = {} # (kind, user): (value, files, mtimes)
+    def get(self, kind, user, load):
+        with self.lock:
+            cached = self.cache.get((kind, user))
+        if cached is not None and file_mtimes(cached[1]) == cached[2]:
+            return copy.deepcopy(cached[0])
+        loaded = load(user)
+        if loaded is None:
+            return None
+        value, files = loaded
+        with self.lock:
+            self.cache[(kind, user)] = (value, files, file_mtimes(files))
+        return copy.deepcopy(value)
+    def invalidate(self, user):
+        """ Forget everything cached about user """
+        with self.lock:
+            for key in [key for key in self.cache if key[1] == user]:
+                del self.cache[key]
+    def domains(self, user):
+        """ A user's domains, from userdata when it can be read, otherwise from UAPI """
+        return self.get('domains', user, lambda user: load_userdata_domains(user) or load_api_domains(user))
+    def ids(self, user):
+        """ A user's (uid, gid), raises KeyError for unknown users """
+        def load(user):
+            return get_user_ids(user), [ROOT + '/etc/passwd']
+        return self.get('ids', user, load)
+    def databases(self, user):
+        """ A user's database names per engine """
+        return self.get('databases', user, load_databases)
+INVENTORY = Inventory()
+class PathScan:
+    """
+    fromcp's and tocp's trees indexed once before anything moves: symlinks
+    resolved a directory at a time, a collision free new docroot for every
+    domain, and the paths that escape fromcp's home or already exist on tocp
+    """
+    def __init__(self, tocp, fromcp, domains, merge_dir, journal=None):
+        self.tocp = tocp
+        self.fromcp = fromcp
+        self.journal = journal # what a resumed merge already moved isn't a collision
+        self.resolved = {} # path of an entry: its realpath
+        self.home = self.resolve(HOME_DIR + fromcp)
+        self.docroots = {} # domain: its docroot in tocp
+        self.movers = {} # domain: the domain whose docroot move carries its docroot
+        self.renamed = [] # docroots given another name in the merge dir
+        self.escapes = [] # paths the merge would move that resolve outside fromcp's home
+        self.collisions = [] # fromcp paths tocp already has
+        self.map_docroots(domains, merge_dir)
+        self.scan_escapes(domains)
+        self.scan_collisions(domains)
+    def resolve(self, path, seen=()):
+        """ realpath of path, lstat'ing each directory once however many paths go through it """
+        real = '/'
+        for name in path.split('/'):
+            if name in ('', '.'):
+                continue
+            if name == '..':
+                real = os.path.dirname(real)
+                continue
+            entry = os.path.join(real, name)
+            if entry not in self.resolved:
+                try:
+                    link = os.readlink(entry) if os.path.islink(entry) else None
+                except OSError:
+                    link = None
+                if link is None or entry in seen:
+                    self.resolved[entry] = entry
+                else:
+                    self.resolved[entry] = self.resolve(os.path.join(real, link), seen + (entry,))
+            real = self.resolved[entry]
+        return real
+    def is_inside(self, path):
+        """ Check path resolves to fromcp's home dir or something in it """
+        real = self.resolve(path)
+        return real == self.home or real.startswith(self.home + '/')
+    def map_docroots(self, domains, merge_dir):
+        """
+        Name every docroot in the merge dir after its basename, renaming ones
+        that would land on the same name, a docroot inside another addon or
+        subdomain docroot moves with it and keeps its place there
+        """
+        taken = set()
+        for domain, docroot in domains["main"].items():
+            self.docroots[domain] = merge_dir + domain
+            self.movers[domain] = domain
+            taken.add(domain)
+        mains = dict((os.path.normpath(docroot), domain) for domain, docroot in domains["main"].items())
+        sources = {}
+        for addon, data in domains["addondomains"].items():
+            sources[addon] = os.path.normpath(data["docroot"])
+        for subdomain, docroot in domains["subdomains"].items():
+            sources[subdomain] = os.path.normpath(docroot)
+        own = [] # (source, domain) of the docroots that are moved themselves
+        # parents come before the docroots nested in them
+        for domain in sorted(sources, key=lambda domain: (sources[domain].count('/'), domain)):
+            src = sources[domain]
+            if src in mains:
+                self.movers[domain] = mains[src]
+                self.docroots[domain] = self.docroots[mains[src]]
+                continue
+            parent = [(parent_src, parent) for parent_src, parent in own \
+                      if src == parent_src or src.startswith(parent_src + '/')]
+            if parent:
+                parent_src, parent = parent[0]
+                self.movers[domain] = parent
+                self.docroots[domain] = self.docroots[parent] + src[len(parent_src):]
+                continue
+            name = os.path.basename(src)
+            if name in taken:
+                unique = name + '_' + domain
+                count = 1
+                while unique in taken:
+                    count += 1
+                    unique = '{}_{}{}'.format(name, domain, count)
+                self.renamed.append("{} docroot {} is moved to {} as {} is taken".format(domain, \
+                                    src, merge_dir + unique, merge_dir + name))
+                name = unique
+            taken.add(name)
+            own.append((src, domain))
+            self.movers[domain] = domain
+            self.docroots[domain] = merge_dir + name
+    def scan_escapes(self, domains):
+        """ Docroots and mail/etc dirs that resolve outside fromcp's home, they are not moved """
+        home = HOME_DIR + self.fromcp
+        paths = [home]
+        for domain, docroot in domains["main"].items():
+            paths.append(docroot)
+        for addon, data in domains["addondomains"].items():
+            paths.append(data["docroot"])
+        paths += domains["subdomains"].values()
+        for domain in merged_domains(domains):
+            paths += [home + '/etc/' + domain, home + '/mail/' + domain]
+        for path in sorted(set(paths)):
+            if os.path.lexists(path) and not self.is_inside(path):
+                self.escapes.append("{} resolves to {} outside {}".format(path, self.resolve(path), home))
+    def scan_collisions(self, domains):
+        """ etc/<domain> and mailboxes tocp already has, from one listing of each of its dirs """
+        home = HOME_DIR + self.fromcp
+        to_home = HOME_DIR + self.tocp
+        for kind in ('etc', 'mail'):
+            try:
+                existing = set(os.listdir(to_home + '/' + kind))
+            except OSError:
+                continue
+            for domain in merged_domains(domains):
+                item = kind + '/' + domain
+                if domain not in existing or not os.path.lexists(home + '/' + item) or self.is_moving(item):
+                    continue
+                to_path = to_home + '/' + item
+                if kind == 'etc' or os.path.islink(to_path) or not os.path.isdir(to_path) or \
+                   os.path.islink(home + '/' + item) or not os.path.isdir(home + '/' + item):
+                    self.collisions.append("{} already exists on {}".format(item, self.tocp))
+                    continue
+                # mailboxes are moved one at a time, only the ones with the same name collide
+                for name in sorted(set(os.listdir(home + '/' + item)) & set(os.listdir(to_path))):
+                    if not self.is_moving(item + '/' + name):
+                        self.collisions.append("{}/{} already exists on {}".format(item, name, self.tocp))
+    def is_moving(self, item):
+        """ Check the journal has a move of item under way """
+        return self.journal is not None and self.journal.state('move_maildir:' + item) is not None
+    def report(self):
+        """ Log what the scan found before anything is moved """
+        for line in self.renamed:
+            logger.info(line)
+        for line in self.escapes:
+            logger.warning("Not moving {}".format(line))
+        for line in self.collisions:
+            logger.warning("Not moving {}".format(line))
+def merged_domains(domains):
+    """ Every domain of fromcp that is merged, addons, subdomains and the main domain """
+    return sorted(domains["addondomains"]) + sorted(domains["subdomains"]) + sorted(domains["main"])
 class Cpmerge:
     """
     Store users and paths, set primary cpanel unlimited quotas, and validate users
     """
-    def __init__(self, tocp, fromcp):
+    def __init__(self, tocp, fromcp, check_api=True, dry_run=False, resume=False):
         self.are_users_valid(tocp, fromcp)
         self.tocp = tocp # cpanel acquiring other cpanel
         self.fromcp = fromcp # cpanel being acquired
-        self.domains = self.set_domains()
+        self.journal = Journal() if dry_run else Journal(journal_path(tocp, fromcp))
+        if resume:
+            self.domains = self.get_resume_domains()
+        else:
+            if self.journal.header is not None and not self.journal.finished:
+                raise MergeError("Unable to continue: an interrupted merge of {} into {} exists, " \
+                         "rerun with --resume".format(fromcp, tocp))
+            self.domains = self.set_domains()
         self.uid = self.get_uid()
         self.gid = self.get_gid()
         self.nobody_gid = self.get_nobody_gid()
-        self.set_unlimited_quotas(tocp)
-        self.merge_dir = self.get_merge_dir()
-        self.can_access_api()
+        self.from_uid, self.from_gid = self.get_from_ids()
+        self.dry_run = dry_run # plan only, change nothing
+        self.resume = resume
+        # nothing is written until prepare(), a declined merge leaves no trace
+        if resume:
+            self.merge_dir = valid_merge_dir(tocp, self.journal.header['merge_dir'])
+            if self.merge_dir is None:
+                raise MergeError("Unable to resume: the journal's merge dir {} is not in {}public_html".format( \
+                         self.journal.header['merge_dir'], HOME_DIR + tocp + '/'))
+        else:
+            self.merge_dir = self.get_merge_dir()
+        # docroots are mapped from the domains and merge dir alone, a resume maps them the same way
+        self.paths = PathScan(tocp, fromcp, self.domains, self.merge_dir, self.journal)
+        metrics_path = None if dry_run else HOME_DIR + tocp + '/.imh/cpmerge-metrics.jsonl'
+        self.metrics = Metrics(tocp, fromcp, metrics_path)
+        # batch runs check the api once up front instead of per pair
+        if check_api:
+            self.can_access_api()
         self.has_errors = False
+        self.failed_domains = set() # domains that could not be added to tocp
+    def get_resume_domains(self):
+        """ fromcp's domains as they were before the interrupted merge changed them """
+        if self.journal.header is None:
+            raise MergeError("Unable to resume: no journal found for {} into {}".format(self.fromcp, self.tocp))
+        if self.journal.finished:
+            raise MergeError("Unable to resume: the merge of {} into {} already finished".format( \
+                     self.fromcp, self.tocp))
+        return defaultdict(dict, self.journal.header['domains'])
     def are_users_valid(self, tocp, fromcp):
         """ Check if user exists """
-        tocp = 'user=' + tocp
-        fromcp = 'user=' + fromcp
-        proc = subprocess.Popen(['whmapi1', 'validate_system_user', tocp], \
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        tocp_data, err = proc.communicate()
-        proc = subprocess.Popen(['whmapi1', 'validate_system_user', fromcp], \
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        fromcp_data, err = proc.communicate()
-        bool_exists = 'exists: 1' in tocp_data and 'exists: 1' in fromcp_data
+        tocp_data = whmapi1('validate_system_user', user=tocp).data or {}
+        fromcp_data = whmapi1('validate_system_user', user=fromcp).data or {}
+        bool_exists = tocp_data.get('exists') == 1 and fromcp_data.get('exists') == 1
         if not bool_exists:
-            sys.exit("Unable to continue: user not found.")
+            raise MergeError("Unable to continue: user not found.")
     def set_unlimited_quotas(self, tocp):
         """ Set unlimited addons/subdomains/mysql """
-        call_user = 'user=' + tocp
-        proc = subprocess.Popen(['whmapi1', 'modifyacct', call_user, 'MAXSUB=unlimited', \
-                    'MAXSQL=unlimited', 'MAXPARK=unlimited', 'MAXADDON=unlimited', \
-                    'MAXPOP=unlimited', 'MAXFTP=unlimited'], stdout=subprocess.PIPE, \
-                    stderr=subprocess.PIPE)
-        output, err = proc.communicate()
-        if 'result: 1' not in output:
-            sys.exit("Unable to continue: unable to increase quotas.")
+        result = whmapi1('modifyacct', user=tocp, MAXSUB='unlimited', MAXSQL='unlimited', \
+                         MAXPARK='unlimited', MAXADDON='unlimited', MAXPOP='unlimited', \
+                         MAXFTP='unlimited')
+        if not result.ok:
+            raise MergeError("Unable to continue: unable to increase quotas.")
     def get_uid(self):
         """ Get the UID """
         try:
-            uid = pwd.getpwnam(self.tocp).pw_uid
-        except OSError:
-            sys.exit("Error finding UID")
+            uid = INVENTORY.ids(self.tocp)[0]
+        except KeyError:
+            raise MergeError("Error finding UID")
         return uid
     def get_gid(self):
         """ Get the GID """
         try:
-            gid = pwd.getpwnam(self.tocp).pw_gid
-        except TypeError:
-            sys.exit("Error finding group id of user")
+            gid = INVENTORY.ids(self.tocp)[1]
+        except KeyError:
+            raise MergeError("Error finding group id of user")
         return gid
+    def get_from_ids(self):
+        """ Get fromcp's UID and GID, whatever it still owns is handed to tocp """
+        try:
+            return INVENTORY.ids(self.fromcp)
+        except KeyError:
+            raise MergeError("Error finding UID of user")
     def get_nobody_gid(self):
         """ Get nobody GID """
         try:
-            gid = pwd.getpwnam('nobody').pw_gid
-        except TypeError:
-            sys.exit("Error finding group id of user")
+            gid = INVENTORY.ids('nobody')[1]
+        except KeyError:
+            raise MergeError("Error finding group id of user")
         return gid
     def set_domains(self):
         """ Get all fromcp's domains/subdomains/addon data """
-        call_user = '--user=' + self.fromcp
-        domain_dict = defaultdict(dict)
-        proc = subprocess.Popen(['uapi', call_user, 'DomainInfo', 'domains_data', \
-                '--output=json'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        json_domains, err = proc.communicate()
-        try:
-            json_domains = (json.loads(json_domains))
-            for dom in json_domains["result"]["data"]["sub_domains"]:
-                subdomain = dom["domain"]
-                docroot = dom["documentroot"]
-                domain_dict["subdomains"][subdomain] = docroot
-            for dom in json_domains["result"]["data"]["addon_domains"]:
-                addon = dom["domain"]
-                docroot = dom["documentroot"]
-                subdomain = dom["servername"]
-                domain_dict["addondomains"][addon] = {"docroot": docroot, "subdomain": subdomain}
-            domain = json_domains["result"]["data"]["main_domain"]["servername"]
-            docroot = json_domains["result"]["data"]["main_domain"]["documentroot"]
-            domain_dict["main"][domain] = docroot
-        except IndexError as err:
-            print err
-            sys.exit("Unable to continue: error parsing users domains.")
+        return self.get_domains(self.fromcp)
+    def get_domains(self, user):
+        """ Get a user's domains/subdomains/addon data """
+        domain_dict = INVENTORY.domains(user)
+        if domain_dict is None:
+            raise MergeError("Unable to continue: error parsing users domains.")
         return domain_dict
     def get_merge_dir(self):
         """ prevent collisions with matching dir names: timestampe append """
-        merge_dir = '/home/' + self.tocp + '/public_html/' + self.fromcp \
-                    + '_domains_' + time.strftime("%Y%m%d-%H%M%S") + '/'
+        # a presync already chose the merge dir its copies are laid out for
+        # one anywhere but right in tocp's public_html is ignored
+        merge_dir = load_presync_state(self.tocp, self.fromcp).get('merge_dir')
+        return valid_merge_dir(self.tocp, merge_dir) or \
+               HOME_DIR + self.tocp + '/public_html/' + self.fromcp \
+               + '_domains_' + time.strftime("%Y%m%d-%H%M%S") + '/'
+    def prepare(self):
+        """ Create the merge dir and start the journal once the merge is confirmed """
+        make_imh_dir(self)
+        if self.resume:
+            return
+        if not os.path.isdir(STATE_DIR):
+            os.makedirs(STATE_DIR, 0o700)
         try:
-            os.mkdir(merge_dir)
-            os.chown(merge_dir, self.uid, self.gid)
+            os.mkdir(self.merge_dir)
+            os.chown(self.merge_dir, self.uid, self.gid)
         except OSError as err:
-            print err
-            sys.exit("Directory already exists: exiting")
-        return merge_dir
+            raise MergeError("Unable to create {}: {}".format(self.merge_dir, os.strerror(err.errno)))
+        self.journal.start(self)
+    def raise_quotas(self):
+        """ Set tocp's unlimited quotas once per run """
+        with target_lock(self.tocp):
+            if self.tocp not in UNLIMITED_QUOTA_USERS:
+                self.set_unlimited_quotas(self.tocp)
+                UNLIMITED_QUOTA_USERS.add(self.tocp)
+    def discard(self):
+        """
+        Forget a new merge that got no further than its snapshot: its journal
+        and empty merge dir, returns True if it did
+        """
+        if self.resume or self.dry_run or [key for key in self.journal.states if key != 'snapshot:configs']:
+            return False
+        self.journal.discard()
+        try:
+            os.rmdir(self.merge_dir)
+        except OSError:
+            pass
+        return True
     def can_access_api(self):
         """ Test WHMAPI access """
-        proc = subprocess.Popen(['whmapi1', 'version', '--output=yaml'], \
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, err = proc.communicate()
-        if 'result: 1' not in output:
-            logging.info("Cannot access WHMAPI. Exiting.")
-            sys.exit()
+        can_access_api()
+class MergePlan:
+    """ Every operation a merge would run, worked out without changing anything """
+    def __init__(self, cp_obj):
+        self.tocp = cp_obj.tocp
+        self.fromcp = cp_obj.fromcp
+        self.merge_dir = cp_obj.merge_dir
+        self.operations = [] # in run_merge order
+        self.conflicts = [] # would make the merge fail or lose data
+        self.warnings = [] # would be skipped
+        self.databases = {}
+    def add(self, step, target, kind, depends=(), size=0, entries=0, copy=False, src=None, dst=None, \
+            skip=(), after=()):
+        """
+        Add an operation, returns its key for other operations to depend on
+        it only waits for the operations in after, it still runs if they fail
+        """
+        key = step + ':' + target
+        self.operations.append({'key': key, 'step': step, 'target': target, 'kind': kind, \
+                                'depends': list(depends), 'after': list(after), 'bytes': size, \
+                                'entries': entries, 'copy': copy, 'src': src, 'dst': dst, \
+                                'skip': sorted(skip)})
+        return key
+    def sources(self):
+        """ Paths the planned moves take data from """
+        return set(os.path.normpath(op['src']) for op in self.operations if op['src'])
+    def keys(self, step):
+        """ Keys of every operation of a step """
+        return [op['key'] for op in self.operations if op['step'] == step]
+    def api_calls(self):
+        return len([op for op in self.operations if op['kind'] == 'api'])
+    def data_bytes(self):
+        return sum(op['bytes'] for op in self.operations)
+    def copy_bytes(self):
+        """ Bytes that have to be copied across filesystems rather than renamed """
+        return sum(op['bytes'] for op in self.operations if op['copy'])
+    def estimate_seconds(self):
+        """ Rough wall time from PLAN_API_SECONDS per call and PLAN_COPY_RATE """
+        seconds = self.copy_bytes() / float(PLAN_COPY_RATE)
+        steps = defaultdict(int)
+        for op in self.operations:
+            if op['kind'] == 'api':
+                steps[op['step']] += 1
+        for step, count in steps.items():
+            width = min(DOMAIN_WORKERS, count) if step in CONCURRENT_STEPS else 1
+            seconds += -(-count // width) * PLAN_API_SECONDS
+        return seconds
+    def as_dict(self):
+        return {'tocp': self.tocp, 'fromcp': self.fromcp, 'merge_dir': self.merge_dir, \
+                'operations': self.operations, 'conflicts': self.conflicts, \
+                'warnings': self.warnings, 'databases': self.databases, \
+                'api_calls': self.api_calls(), 'data_bytes': self.data_bytes(), \
+                'copy_bytes': self.copy_bytes(), 'estimated_seconds': self.estimate_seconds()}
+def existing_dir(path):
+    """ path or its closest ancestor that exists """
+    path = os.path.normpath(path)
+    # the merge dir doesn't exist until the real run, check its parent
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+def is_cross_device(src, dst_dir):
+    """ Check if moving src into dst_dir would have to copy """
+    return os.lstat(src).st_dev != os.stat(existing_dir(dst_dir)).st_dev
+def plan_move(plan, cp_obj, step, target, src, dst, depends=(), skip=(), measure=True):
+    """
+    Add a directory move to the plan, returns its key or None when it would be skipped
+    Without measure the source isn't walked for its size
+    """
+    if not os.path.lexists(src):
+        return None
+    if not is_realpath(cp_obj, src):
+        plan.warnings.append("{} {} is outside {} and will not be moved".format(step, \
+                             src, HOME_DIR + cp_obj.fromcp))
+        return None
+    if os.path.lexists(dst):
+        plan.conflicts.append("{} {}: {} already exists".format(step, target, dst))
+    if not measure:
+        return plan.add(step, target, 'io', depends, src=src, dst=dst, skip=skip)
+    entries, size = tree_totals(src, skip)
+    return plan.add(step, target, 'io', depends, size, entries, \
+                    is_cross_device(src, os.path.dirname(dst)), src, dst, skip)
+def plan_databases(plan, cp_obj):
+    """ Count the db entries reassign_dbs would move """
+    try:
+        with open(DATABASES_DIR + cp_obj.fromcp + '.json', 'r') as infile:
+            fromcp_json = json.load(infile)
+    except (IOError, ValueError) as err:
+        plan.warnings.append("Unable to read {}'s database json: {}".format(cp_obj.fromcp, err))
+        return
+    for engine in ('MYSQL', 'PGSQL'):
+        engine_json = fromcp_json.get(engine) or {}
+        plan.databases[engine] = {'dbs': len(engine_json.get('dbs') or {}), \
+                                  'dbusers': len(engine_json.get('dbusers') or {})}
+def plan_merge(cp_obj, measure=True):
+    """
+    Build the operations run_merge would perform for cp_obj, with their
+    dependencies, data sizes and any conflicts, without changing anything
+    """
+    plan = MergePlan(cp_obj)
+    domains = cp_obj.domains
+    home = HOME_DIR + cp_obj.fromcp
+    tocp_domains = cp_obj.get_domains(cp_obj.tocp)
+    existing = set()
+    for kind in ('main', 'addondomains', 'subdomains', 'parked'):
+        existing.update(tocp_domains[kind])
+    all_domains = merged_domains(domains)
+    for domain in sorted(domains["parked"]):
+        plan.warnings.append("Parked domain {} is not merged".format(domain))
+    for domain in all_domains:
+        if domain in existing:
+            plan.conflicts.append("{} already exists on {}".format(domain, cp_obj.tocp))
+    # addons and the main domain are added with their first label as subdomain
+    labels = defaultdict(list)
+    for domain in list(domains["addondomains"]) + list(domains["main"]):
+        labels[domain.split('.', 1)[0]].append(domain)
+    for label, label_domains in sorted(labels.items()):
+        if len(label_domains) > 1:
+            plan.conflicts.append("{} would all be added with subdomain {}".format( \
+                                  ', '.join(sorted(label_domains)), label))
+    plan.add('snapshot', 'configs', 'io')
+    to_home = HOME_DIR + cp_obj.tocp
+    for domain in all_domains:
+        plan_move(plan, cp_obj, 'move_maildir', 'etc/' + domain, home + '/etc/' + domain, \
+                  to_home + '/etc/' + domain, measure=measure)
+    for domain in all_domains:
+        names = mailbox_names(cp_obj, domain)
+        if names is None:
+            plan_move(plan, cp_obj, 'move_maildir', 'mail/' + domain, home + '/mail/' + domain, \
+                      to_home + '/mail/' + domain, measure=measure)
+            continue
+        # mailbox quotas are read from the moved etc dir
+        etc = [key for key in plan.keys('move_maildir') if key == 'move_maildir:etc/' + domain]
+        for name in names:
+            item = 'mail/' + domain + '/' + name
+            plan_move(plan, cp_obj, 'move_maildir', item, home + '/' + item, to_home + '/' + item, \
+                      etc, measure=measure)
+    paths = cp_obj.paths
+    plan.warnings.extend(paths.renamed)
+    docroots = {}
+    for addon in sorted(domains["addondomains"]):
+        docroots[addon] = domains["addondomains"][addon]["docroot"]
+    for subdomain in sorted(domains["subdomains"]):
+        docroots[subdomain] = domains["subdomains"][subdomain]
+    # docroots nested in another addon/subdomain docroot move with it
+    docroots = dict((domain, docroot) for domain, docroot in docroots.items() \
+                    if paths.movers[domain] == domain)
+    for domain, docroot in sorted(docroots.items()):
+        plan_move(plan, cp_obj, 'move_docroot', domain, docroot, paths.docroots[domain], measure=measure)
+    nested = set(os.path.normpath(docroot) for docroot in docroots.values())
+    for domain in sorted(domains["main"]):
+        # the main docroot goes last, without the addon/subdomain docroots moved out of it
+        plan_move(plan, cp_obj, 'move_docroot', domain, domains["main"][domain], paths.docroots[domain], \
+                  plan.keys('move_docroot'), nested, measure)
+    moves = plan.keys('move_maildir') + plan.keys('move_docroot')
+    for addon in sorted(domains["addondomains"]):
+        docroot = 'move_docroot:' + paths.movers[addon]
+        moved = [key for key in moves if key in ('move_maildir:etc/' + addon, 'move_maildir:mail/' + addon, \
+                                                 docroot) \
+                 or key.startswith('move_maildir:mail/' + addon + '/')]
+        plan.add('del_addon', addon, 'api', moved)
+        plan.add('add_addon', addon, 'api', ['del_addon:' + addon] + [key for key in moved if key == docroot])
+    for domain in sorted(domains["main"]):
+        # only the main domain's own moves have to succeed, a failed addon or subdomain
+        # mailbox holds back that domain alone
+        own = [key for key in moves if key in ('move_maildir:etc/' + domain, 'move_maildir:mail/' + domain, \
+                                               'move_docroot:' + domain) \
+               or key.startswith('move_maildir:mail/' + domain + '/')]
+        plan.add('rename_main', domain, 'api', own, after=[key for key in moves if key not in own] + \
+                 plan.keys('del_addon'))
+        plan.add('add_main', domain, 'api', ['rename_main:' + domain] + \
+                 [key for key in moves if key == 'move_docroot:' + domain])
+    for wave in subdomain_waves(domains["subdomains"]):
+        for subdomain in wave:
+            rootdomain = subdomain.split('.', 1)[1]
+            depends = plan.keys('rename_main') + \
+                      [key for key in moves if key == 'move_docroot:' + paths.movers[subdomain]]
+            for step in ('add_addon', 'add_main', 'add_subdomain'):
+                if step + ':' + rootdomain in plan.keys(step):
+                    depends.append(step + ':' + rootdomain)
+            plan.add('add_subdomain', subdomain, 'api', depends)
+    if BULK_DNS:
+        plan.add('restore_zones', 'named', 'io', plan.keys('add_addon') + plan.keys('add_main') + \
+                 plan.keys('add_subdomain'))
+    plan_databases(plan, cp_obj)
+    plan.add('reassign_dbs', cp_obj.fromcp, 'api')
+    plan.add('fix_perms', cp_obj.tocp, 'io', [op['key'] for op in plan.operations])
+    # what's left of the home dir once everything else has moved out
+    plan_move(plan, cp_obj, 'move_homedir', cp_obj.fromcp, home, HOME_DIR + cp_obj.tocp + '/' + \
+              cp_obj.fromcp, [op['key'] for op in plan.operations], plan.sources(), measure)
+    if measure:
+        plan.conflicts.extend(space_shortfalls(copy_requirements(cp_obj, plan)))
+    return plan
+def report_plan(plan):
+    """ Log a merge plan """
+    logger.info("Plan for merging {} into {}:".format(plan.fromcp, plan.tocp))
+    steps = defaultdict(int)
+    for op in plan.operations:
+        steps[op['step']] += 1
+    for op in plan.operations:
+        if op['kind'] == 'io' and op['bytes']:
+            logger.info("    {} {}: {:.1f} MB, {} entries{}".format(op['step'], op['target'], \
+                        op['bytes'] / 1048576.0, op['entries'], ' (cross device copy)' if op['copy'] else ''))
+    for step in sorted(steps):
+        logger.info("    {}: {} operations".format(step, steps[step]))
+    for engine, counts in sorted(plan.databases.items()):
+        logger.info("    {}: {} databases, {} users".format(engine, counts['dbs'], counts['dbusers']))
+    logger.info("    {} API calls, {:.1f} MB of data, {:.1f} MB copied across filesystems".format( \
+                plan.api_calls(), plan.data_bytes() / 1048576.0, plan.copy_bytes() / 1048576.0))
+    logger.info("    Estimated duration: {:.0f}s".format(plan.estimate_seconds()))
+    for warning in plan.warnings:
+        logger.warning("    {}".format(warning))
+    for conflict in plan.conflicts:
+        logger.error("    Conflict: {}".format(conflict))
+    return not plan.conflicts
+def dry_run(pairs, plan_file=None):
+    """ Plan every (tocp, fromcp) pair without changing anything, returns True if none conflict """
+    can_access_api()
+    plans = []
+    no_conflicts = True
+    for tocp, fromcp in pairs:
+        cp_obj = Cpmerge(tocp, fromcp, check_api=False, dry_run=True)
+        plan = plan_merge(cp_obj)
+        no_conflicts = report_plan(plan) and no_conflicts
+        plans.append(plan.as_dict())
+    if len(plans) > 1:
+        logger.info("Batch total: {} API calls, {:.1f} MB of data, estimated {:.0f}s".format( \
+                    sum(plan['api_calls'] for plan in plans), \
+                    sum(plan['data_bytes'] for plan in plans) / 1048576.0, \
+                    sum(plan['estimated_seconds'] for plan in plans)))
+    if plan_file:
+        with open(plan_file, 'w') as outfile:
+            json.dump(plans, outfile, indent=2, sort_keys=True)
+    return no_conflicts
+def presync_path(tocp, fromcp):
+    """ Where presynced copies of fromcp's data wait, out of reach of both accounts """
+    return PRESYNC_DIR + tocp + '-' + fromcp
+def presync_state_path(tocp, fromcp):
+    return presync_path(tocp, fromcp) + '.json'
+def staging_dir(path):
+    """
+    Create path and its missing parents below PRESYNC_DIR root only, refusing
+    a symlink or non directory anywhere from PRESYNC_DIR down
+    """
+    top = os.path.normpath(PRESYNC_DIR)
+    path = os.path.normpath(path)
+    if path != top and not path.startswith(top + '/'):
+        raise OSError(errno.EPERM, "Not a presync path", path)
+    current = top
+    for name in [''] + [name for name in path[len(top):].split('/') if name]:
+        current = os.path.join(current, name) if name else current
+        try:
+            st = os.lstat(current)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            os.mkdir(current, 0o700)
+            st = os.lstat(current)
+        if not stat.S_ISDIR(st.st_mode):
+            raise OSError(errno.ENOTDIR, "Refusing a symlink or file in the presync dir", current)
+        if current == top and (st.st_uid != os.geteuid() or stat.S_IMODE(st.st_mode) & 0o077):
+            raise OSError(errno.EPERM, "The presync dir must be owned by root and mode 0700", current)
+    return path
+def load_presync_state(tocp, fromcp):
+    """ The merge dir and pass count of earlier presyncs, empty without any """
+    try:
+        with open(presync_state_path(tocp, fromcp), 'r') as infile:
+            return json.load(infile)
+    except (IOError, ValueError):
+        return {}
+def valid_merge_dir(tocp, merge_dir):
+    """ merge_dir normalized if it names a directory right in tocp's public_html, else None """
+    if not isinstance(merge_dir, basestring):
+        return None
+    path = os.path.normpath(merge_dir)
+    if os.path.dirname(path) != HOME_DIR + tocp + '/public_html':
+        return None
+    return path + '/'
+def staged_path(tocp, fromcp, dst):
+    """ Where the presynced copy of a move to dst is kept, None if dst is outside tocp's home """
+    home = HOME_DIR + tocp + '/'
+    dst = os.path.normpath(dst)
+    if not dst.startswith(home):
+        return None
+    return presync_path(tocp, fromcp) + '/' + dst[len(home):]
+def presynced_copy(tocp, fromcp, dst):
+    """ The presynced copy of a move to dst, None without one it can be renamed from """
+    staged = staged_path(tocp, fromcp, dst)
+    if staged is None or not os.path.lexists(staged):
+        return None
+    staging_dir(os.path.dirname(staged))
+    if os.lstat(staged).st_dev != os.stat(existing_dir(os.path.dirname(dst))).st_dev:
+        return None
+    return staged
+def remove_presync(tocp, fromcp):
+    """ Drop the presync copies and state of a finished merge """
+    for path in (presync_path(tocp, fromcp), presync_state_path(tocp, fromcp)):
+        try:
+            if os.path.lexists(path):
+                remove_tree(path)
+        except OSError as err:
+            logger.warning("Unable to remove {}: {}".format(path, os.strerror(err.errno)))
+def presync_pair(tocp, fromcp, checksum=False):
+    """
+    One delta pass copying a merge's cross filesystem docroot and mail moves
+    into the pair's presync dir, laid out for the merge dir the cutover will use
+    returns True without errors
+    """
+    cp_obj = Cpmerge(tocp, fromcp, check_api=False, dry_run=True)
+    staging_dir(PRESYNC_DIR)
+    state = load_presync_state(tocp, fromcp)
+    # saved first so the cutover lays out its moves like these copies even if this pass fails
+    state['merge_dir'] = cp_obj.merge_dir
+    atomic_write(presync_state_path(tocp, fromcp), json.dumps(state, sort_keys=True))
+    plan = plan_merge(cp_obj)
+    start = time.time()
+    copied = 0
+    success = True
+    for op in plan.operations:
+        if not op['copy'] or op['step'] not in ('move_docroot', 'move_maildir'):
+            continue
+        staged = staged_path(tocp, fromcp, op['dst'])
+        try:
+            if os.stat(PRESYNC_DIR).st_dev != os.stat(existing_dir(os.path.dirname(op['dst']))).st_dev:
+                logger.warning("Not presyncing {}: {} is on another filesystem than {}".format( \
+                               op['src'], PRESYNC_DIR, op['dst']))
+                continue
+            staging_dir(os.path.dirname(staged))
+            copied += sync_tree(op['src'], staged, set(op['skip']), checksum)
+        except (OSError, IOError) as err:
+            logger.error("Error presyncing {}: \n{}".format(op['src'], err))
+            success = False
+    state['passes'] = state.get('passes', 0) + 1
+    state['last_pass'] = time.time()
+    atomic_write(presync_state_path(tocp, fromcp), json.dumps(state, sort_keys=True))
+    logger.info("Presync pass {} of {} into {}: {:.1f} MB copied in {:.1f}s".format(state['passes'], \
+                fromcp, tocp, copied / 1048576.0, time.time() - start))
+    return success
+def presync(pairs, checksum=False):
+    """ Presync every (tocp, fromcp) pair, returns True without errors """
+    can_access_api()
+    return all([presync_pair(tocp, fromcp, checksum) for tocp, fromcp in pairs])
+def copy_requirements(cp_obj, plan):
+    """
+    Bytes and inodes the plan's cross filesystem moves need on their
+    destinations, less what presync already copied there
+    returns {st_dev: [path, bytes, inodes]}
+    """
+    needs = {}
+    for op in plan.operations:
+        src = op['src']
+        if src is None or cp_obj.journal.state(op['key']) in ('copied', 'done') or \
+           not os.path.lexists(src):
+            continue
+        dst_dir = existing_dir(os.path.dirname(op['dst']))
+        dev = os.stat(dst_dir).st_dev
+        if os.lstat(src).st_dev == dev:
+            continue
+        if op['entries']:
+            entries, size = op['entries'], op['bytes']
+        else:
+            entries, size = tree_totals(src, set(op['skip']))
+        staged = presynced_copy(cp_obj.tocp, cp_obj.fromcp, op['dst'])
+        if staged is not None:
+            staged_entries, staged_size = tree_totals(staged)
+            entries, size = max(0, entries - staged_entries), max(0, size - staged_size)
+        need = needs.setdefault(dev, [dst_dir, 0, 0])
+        # named after the shallowest destination on the filesystem
+        need[0] = min(need[0], dst_dir, key=len)
+        need[1] += size
+        need[2] += entries
+    return needs
+def space_shortfalls(needs, reserved=None):
+    """ Why needs don't fit their filesystems past MIN_FREE_FRACTION and what reserved holds """
+    shortfalls = []
+    for dev, (path, size, entries) in sorted(needs.items()):
+        st = os.statvfs(path)
+        held = reserved.get(dev, (0, 0)) if reserved else (0, 0)
+        spare = st.f_bavail * st.f_frsize - st.f_blocks * st.f_frsize * MIN_FREE_FRACTION - held[0]
+        if size > spare:
+            shortfalls.append("{:.1f} MB to copy to {} with {:.1f} MB to spare".format(size / 1048576.0, \
+                              path, max(spare, 0) / 1048576.0))
+        # some filesystems, btrfs among them, have no inode limit
+        if st.f_files:
+            spare = st.f_favail - st.f_files * MIN_FREE_FRACTION - held[1]
+            if entries > spare:
+                shortfalls.append("{} inodes to copy to {} with {} to spare".format(entries, path, \
+                                  max(int(spare), 0)))
+    return shortfalls
+def io_pressure():
+    """ Share of the last 10s tasks stalled on io (PSI some avg10), None where the kernel has no PSI """
+    try:
+        with open(IO_PRESSURE_FILE, 'r') as infile:
+            for line in infile:
+                if line.startswith('some '):
+                    return float(dict(field.split('=', 1) for field in line.split()[1:])['avg10'])
+    except (IOError, ValueError, KeyError):
+        pass
+    return None
+@contextlib.contextmanager
+def admission(cp_obj):
+    """
+    Hold a merge back until the filesystems its moves copy to have room for
+    it next to what running merges reserved, and io pressure is below
+    IO_PRESSURE_LIMIT, then reserve that room until it finishes
+    yields False, with the reason logged, when it can't be admitted
+    """
+    reason = None
+    try:
+        needs = copy_requirements(cp_obj, plan_merge(cp_obj, False))
+        reason = '; '.join(space_shortfalls(needs)) or None
+    except OSError as err:
+        needs = {}
+        reason = "{}: {}".format(err.filename, os.strerror(err.errno))
+    deadline = time.time() + ADMISSION_WAIT
+    waiting = False
+    with RESERVATIONS_LOCK:
+        while reason is None:
+            pressure = io_pressure() if needs and IO_PRESSURE_LIMIT is not None else None
+            shortfalls = space_shortfalls(needs, RESERVATIONS)
+            if pressure is not None and pressure > IO_PRESSURE_LIMIT:
+                shortfalls.append("io pressure {:.1f} is over {:.1f}".format(pressure, IO_PRESSURE_LIMIT))
+            if not shortfalls:
+                for dev, (path, size, entries) in needs.items():
+                    RESERVATIONS[dev][0] += size
+                    RESERVATIONS[dev][1] += entries
+                break
+            if time.time() >= deadline:
+                reason = "still waiting after {}s: {}".format(ADMISSION_WAIT, '; '.join(shortfalls))
+                break
+            if not waiting:
+                logger.info("Waiting for other merges or io to let this one start: {}".format( \
+                            '; '.join(shortfalls)))
+                waiting = True
+            RESERVATIONS_LOCK.wait(5)
+    if reason is not None:
+        logger.error("Not starting the merge: {}".format(reason))
+        cp_obj.has_errors = True
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        with RESERVATIONS_LOCK:
+            for dev, (path, size, entries) in needs.items():
+                RESERVATIONS[dev][0] -= size
+                RESERVATIONS[dev][1] -= entries
+            RESERVATIONS_LOCK.notify_all()
+def atomic_write(path, data):
+    """
+    Replace path with data so readers never see a partial file
+    an existing file's mode and owner are kept
+    """
+    tmp_path = '{}.tmp-{}-{}'.format(path, os.getpid(), threading.current_thread().ident)
+    with open(tmp_path, 'w') as outfile:
+        outfile.write(data)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    try:
+        st = os.stat(path)
+    except OSError:
+        pass
+    else:
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+        os.chown(tmp_path, st.st_uid, st.st_gid)
+    os.rename(tmp_path, path)
+def yaml_load(stream):
+    """ Parse yaml with the libyaml loader when pyyaml was built with it """
+    return yaml.load(stream, Loader=YAML_LOADER)
+def yaml_dump(data):
+    """ Serialize yaml with the libyaml dumper when pyyaml was built with it """
+    return yaml.dump(data, Dumper=YAML_DUMPER, default_flow_style=False)
+class Metrics:
+    """
+    Wall times, API call latencies, bytes moved and error counts of one merge
+    Every event is appended to path as a json line when it happens
+    """
+    def __init__(self, tocp, fromcp, path=None):
+        self.tocp = tocp
+        self.fromcp = fromcp
+        self.path = path # None only keeps the numbers in memory
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.seconds = None
+        self.success = None
+        self.steps = [] # [name, seconds, errors] in the order they ran
+        self.api = {} # (api, function): [calls, errors, seconds, max seconds]
+        self.moves = {'rename': 0, 'copy': 0, 'bytes': 0}
+        self.errors = 0
+    def emit(self, event, **fields):
+        """ Append an event to the json lines file """
+        if self.path is None:
+            return
+        fields.update({'event': event, 'tocp': self.tocp, 'fromcp': self.fromcp, 'time': time.time()})
+        try:
+            with open(self.path, 'a') as outfile:
+                outfile.write(json.dumps(fields, sort_keys=True) + '\n')
+        except IOError as err:
+            self.path = None
+            logger.warning("Unable to write metrics, disabling: {}".format(os.strerror(err.errno)))
+    @contextlib.contextmanager
+    def counting(self, entry):
+        """ Count the errors this thread, and the workers it starts, log against entry """
+        previous = getattr(_merge_context, 'step', None)
+        _merge_context.step = entry
+        try:
+            yield entry
+        finally:
+            _merge_context.step = previous
+    @contextlib.contextmanager
+    def step(self, name):
+        """ Time a step and count the errors logged while it runs """
+        entry = [name, 0.0, 0]
+        with self.lock:
+            self.steps.append(entry)
+        start = time.time()
+        try:
+            with self.counting(entry):
+                yield
+        finally:
+            with self.lock:
+                entry[1] = time.time() - start
+                self.emit('step', step=name, seconds=entry[1], errors=entry[2])
+    def record_step(self, name, seconds, errors):
+        """ Add a step timed elsewhere, like the operations of a step graph """
+        with self.lock:
+            self.steps.append([name, seconds, errors])
+            self.emit('step', step=name, seconds=seconds, errors=errors)
+    def record_api(self, api, func, seconds, ok):
+        with self.lock:
+            entry = self.api.setdefault((api, func), [0, 0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += 0 if ok else 1
+            entry[2] += seconds
+            entry[3] = max(entry[3], seconds)
+            self.emit('api_call', api=api, function=func, seconds=seconds, ok=ok)
+    def record_move(self, src, dst, copied, seconds):
+        with self.lock:
+            self.moves['copy' if copied else 'rename'] += 1
+            self.moves['bytes'] += copied
+            self.emit('move', src=src, dst=dst, bytes=copied, seconds=seconds)
+    def record_error(self):
+        entry = getattr(_merge_context, 'step', None)
+        with self.lock:
+            self.errors += 1
+            if entry is not None:
+                entry[2] += 1
+    def finish(self, success):
+        """ Close the merge's metrics with a summary event """
+        self.seconds = time.time() - self.start
+        self.success = success
+        with self.lock:
+            self.emit('summary', seconds=self.seconds, success=success, errors=self.errors, \
+                      steps=dict((name, seconds) for name, seconds, errors in self.steps), \
+                      api_calls=sum(entry[0] for entry in self.api.values()), \
+                      api_seconds=sum(entry[2] for entry in self.api.values()), moves=self.moves)
+        logger.info("Timings: {}".format(', '.join('{} {:.1f}s'.format(name, seconds) \
+                    for name, seconds, errors in self.steps)))
+    def prometheus_lines(self):
+        """ This merge's samples in prometheus text format, as (metric, line) pairs """
+        labels = 'tocp="{}",fromcp="{}"'.format(prom_escape(self.tocp), prom_escape(self.fromcp))
+        lines = [('cpmerge_merge_seconds', 'cpmerge_merge_seconds{{{}}} {}'.format(labels, self.seconds)), \
+                 ('cpmerge_merge_success', 'cpmerge_merge_success{{{}}} {}'.format(labels, int(bool(self.success)))), \
+                 ('cpmerge_errors_total', 'cpmerge_errors_total{{{}}} {}'.format(labels, self.errors)), \
+                 ('cpmerge_moved_bytes_total', 'cpmerge_moved_bytes_total{{{}}} {}'.format(labels, \
+                  self.moves['bytes']))]
+        for method in ('rename', 'copy'):
+            lines.append(('cpmerge_moves_total', 'cpmerge_moves_total{{{},method="{}"}} {}'.format( \
+                          labels, method, self.moves[method])))
+        for name, seconds, errors in self.steps:
+            step_labels = '{},step="{}"'.format(labels, name)
+            lines.append(('cpmerge_step_seconds', 'cpmerge_step_seconds{{{}}} {}'.format(step_labels, seconds)))
+            lines.append(('cpmerge_step_errors', 'cpmerge_step_errors{{{}}} {}'.format(step_labels, errors)))
+        for (api, func), (calls, errors, seconds, max_seconds) in sorted(self.api.items()):
+            api_labels = '{},api="{}",function="{}"'.format(labels, api, prom_escape(func))
+            for metric, value in (('cpmerge_api_calls_total', calls), ('cpmerge_api_errors_total', errors), \
+                                  ('cpmerge_api_seconds_sum', seconds), ('cpmerge_api_seconds_max', max_seconds)):
+                lines.append((metric, '{}{{{}}} {}'.format(metric, api_labels, value)))
+        return lines
+class MetricsHandler(logging.Handler):
+    """ Count logged errors against the merge and step that logged them """
+    def emit(self, record):
+        metrics = getattr(_merge_context, 'metrics', None)
+        if metrics is not None:
+            metrics.record_error()
+def prom_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+def set_prometheus_file(path):
+    """ Write the metrics of every finished merge to a textfile collector file """
+    global PROM_FILE
+    PROM_FILE = path
+def publish_metrics(metrics):
+    """ Add a finished merge to the prometheus textfile """
+    with FINISHED_METRICS_LOCK:
+        # a rerun of a merge replaces its earlier numbers, a daemon would pile them up otherwise
+        FINISHED_METRICS[:] = [finished for finished in FINISHED_METRICS \
+                               if (finished.tocp, finished.fromcp) != (metrics.tocp, metrics.fromcp)]
+        FINISHED_METRICS.append(metrics)
+        if PROM_FILE is None:
+            return
+        samples = defaultdict(list)
+        for finished in FINISHED_METRICS:
+            for metric, line in finished.prometheus_lines():
+                samples[metric].append(line)
+        text = ''
+        for metric in sorted(samples):
+            kind = 'counter' if metric.endswith('_total') else 'gauge'
+            text += '# TYPE {} {}\n'.format(metric, kind) + '\n'.join(samples[metric]) + '\n'
+        try:
+            atomic_write(PROM_FILE, text)
+        except (IOError, OSError) as err:
+            logger.warning("Unable to write {}: {}".format(PROM_FILE, os.strerror(err.errno)))
+def run_step(cp_obj, step, journal_key=None):
+    """ Run a step timed in the merge's metrics, once per journal when given a key """
+    with cp_obj.metrics.step(step.__name__):
+        if journal_key is None:
+            step(cp_obj)
+        else:
+            run_once(cp_obj, journal_key, step)
+def run_merge_steps(cp_obj):
+    """ Run the steps that change the accounts, in order """
+    if not SERIAL_STEPS:
+        # steps writing to tocp's domains, databases and perms run one merge at a time
+        with target_lock(cp_obj.tocp):
+            run_merge_graph(cp_obj)
+        return
+    run_step(cp_obj, move_maildirs)
+    run_step(cp_obj, move_docroots)
+    run_step(cp_obj, del_addons)
+    # steps writing to tocp's domains, databases and perms run one merge at a time
+    with target_lock(cp_obj.tocp):
+        run_step(cp_obj, add_addons)
+        run_step(cp_obj, rename_main)
+        run_step(cp_obj, add_main)
+        run_step(cp_obj, add_subdomains)
+        if BULK_DNS:
+            run_step(cp_obj, restore_zones, 'restore_zones:named')
+        run_step(cp_obj, reassign_dbs, 'reassign_dbs:' + cp_obj.fromcp)
+        run_step(cp_obj, fix_perms, 'fix_perms:' + cp_obj.tocp)
+    if not cp_obj.has_errors:
+        logger.info("Moving homedir...")
+        run_step(cp_obj, move_homedir)
+def run_graph_op(cp_obj, op, entry):
+    """ Run one operation of the merge's graph, entry counts the errors it logs """
+    step, target = op['step'], op['target']
+    if step == 'move_maildir':
+        if target.startswith('mail/') and target.count('/') == 2:
+            return move_mailbox(cp_obj, *target.split('/')[1:])
+        return move_mail_item(cp_obj, target)
+    if step == 'move_docroot':
+        return move_docroot(cp_obj, target, op['src'], op['dst'])
+    if step == 'del_addon':
+        return del_addon(cp_obj, target)
+    if step == 'add_addon':
+        return add_addon(cp_obj, target)
+    if step == 'add_subdomain':
+        return add_subdomain(cp_obj, target)
+    # the rest are whole steps, failed when they log errors
+    func = {'rename_main': rename_main, 'add_main': add_main, 'restore_zones': restore_zones, \
+            'reassign_dbs': reassign_dbs, 'fix_perms': fix_perms, 'move_homedir': move_homedir}[step]
+    if step in ('restore_zones', 'reassign_dbs', 'fix_perms'):
+        if cp_obj.journal.is_done(op['key']):
+            logger.info("Skipping {}: already done".format(op['key']))
+            return True
+        errors = entry[2]
+        # operations that failed before an always step ran have set has_errors by now
+        had_errors = cp_obj.has_errors
+        func(cp_obj)
+        if entry[2] == errors and not (had_errors and step in GRAPH_ALWAYS_STEPS):
+            cp_obj.journal.mark(op['key'])
+        return entry[2] == errors
+    if step == 'move_homedir':
+        logger.info("Moving homedir...")
+    func(cp_obj)
+    return True
+def run_merge_graph(cp_obj):
+    """
+    Run the merge as plan_merge's dependency graph: moves run MAIL_WORKERS
+    at a time next to DOMAIN_WORKERS API calls, each operation once what it
+    depends on is done, so the main docroot still moves after the others,
+    subdomains wait for their root domain and the home dir moves last
+    """
+    operations = [op for op in plan_merge(cp_obj, False).operations if op['step'] != 'snapshot']
+    timings = {}
+    timings_lock = threading.Lock()
+    def run_op(op):
+        entry = [op['step'], 0.0, 0]
+        start = time.time()
+        with cp_obj.metrics.counting(entry):
+            ok = run_graph_op(cp_obj, op, entry) and not entry[2]
+        with timings_lock:
+            timing = timings.setdefault(GRAPH_STEP_NAMES.get(op['step'], op['step']), [start, 0.0, 0])
+            timing[0] = min(timing[0], start)
+            timing[1] = max(timing[1], time.time())
+            timing[2] += entry[2]
+        if not ok:
+            cp_obj.has_errors = True
+        return ok
+    def skip_op(op, failed):
+        logger.warning("Skipping {}: {} did not finish".format(op['key'], failed))
+        cp_obj.has_errors = True
+        if op['step'] in ('add_addon', 'add_main', 'add_subdomain'):
+            cp_obj.failed_domains.add(op['target'])
+    run_graph(operations, run_op, {'io': MAIL_WORKERS, 'api': DOMAIN_WORKERS}, GRAPH_ALWAYS_STEPS, skip_op)
+    for name, (start, end, errors) in sorted(timings.items(), key=lambda item: item[1][0]):
+        cp_obj.metrics.record_step(name, end - start, errors)
+def run_merge(cp_obj):
+    """
+    Run the merge steps for a confirmed cp object
+    - Move docroots/conf files before renaming main cpanel
+    - Must add main domain before we can add subdomains
+    """
+    if not any(isinstance(handler, MetricsHandler) for handler in logger.handlers):
+        logger.addHandler(MetricsHandler(logging.ERROR))
+    _merge_context.metrics = cp_obj.metrics
+    cp_obj.paths.report()
+    with admission(cp_obj) as admitted:
+        if admitted:
+            try:
+                cp_obj.prepare()
+                with target_lock(cp_obj.tocp):
+                    run_step(cp_obj, snapshot_configs, 'snapshot:configs')
+                # nothing is changed without a snapshot to roll back to
+                if not cp_obj.has_errors:
+                    cp_obj.raise_quotas()
+            except MergeError as err:
+                logger.error(str(err))
+                cp_obj.has_errors = True
+        if not cp_obj.has_errors:
+            run_merge_steps(cp_obj)
+    if cp_obj.has_errors and cp_obj.discard():
+        logger.info("Nothing was changed: fix the errors and rerun the merge")
+    elif cp_obj.has_errors:
+        logger.info("Completed with errors: please check the .imh/cpmerge.log for errors")
+        logger.info("Fix the errors and rerun with --resume to retry what is left")
+    else:
+        cp_obj.journal.finish()
+        remove_presync(cp_obj.tocp, cp_obj.fromcp)
+        logger.info("Completed successfully!")
+    # both accounts changed, later merges in the run have to look them up again
+    INVENTORY.invalidate(cp_obj.tocp)
+    INVENTORY.invalidate(cp_obj.fromcp)
+    cp_obj.metrics.finish(not cp_obj.has_errors)
+    publish_metrics(cp_obj.metrics)
+    _merge_context.metrics = None
+    return not cp_obj.has_errors
+def load_manifest(path):
+    """
+    Read (tocp, fromcp) pairs from a json, yaml or csv manifest
+    json/yaml: list of {"tocp": .., "fromcp": ..} mappings or [tocp, fromcp] lists
+    csv: one tocp,fromcp row per merge, an optional tocp,fromcp header is skipped
+    """
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        with open(path, 'r') as infile:
+            if ext == '.csv':
+                entries = [row for row in csv.reader(infile) if row and not row[0].startswith('#')]
+                if entries and [col.strip().lower() for col in entries[0][:2]] == ['tocp', 'fromcp']:
+                    entries = entries[1:]
+            elif ext == '.json':
+                entries = json.load(infile)
+            else:
+                entries = yaml_load(infile)
+    except (IOError, ValueError, yaml.YAMLError) as err:
+        raise MergeError("Unable to read manifest {}: {}".format(path, err))
+    if isinstance(entries, dict):
+        entries = entries.get('merges', [])
+    pairs = []
+    for entry in entries or []:
+        if isinstance(entry, dict):
+            pair = (entry.get('tocp'), entry.get('fromcp'))
+        else:
+            pair = tuple(entry[:2])
+        if len(pair) != 2 or not all(pair):
+            raise MergeError("Invalid manifest entry: {}".format(entry))
+        pairs.append((str(pair[0]).strip(), str(pair[1]).strip()))
+    # every fromcp is removed by its merge so it can't be merged twice or receive merges
+    fromcps = [fromcp for tocp, fromcp in pairs]
+    tocps = set(tocp for tocp, fromcp in pairs)
+    for tocp, fromcp in pairs:
+        if tocp == fromcp:
+            raise MergeError("Invalid manifest entry: {} can't be merged into itself".format(fromcp))
+        if fromcps.count(fromcp) > 1:
+            raise MergeError("Invalid manifest: {} is listed as fromcp more than once".format(fromcp))
+        if fromcp in tocps:
+            raise MergeError("Invalid manifest: {} is listed as both tocp and fromcp".format(fromcp))
+    if not pairs:
+        raise MergeError("Manifest {} contains no merges".format(path))
+    return pairs
+def is_batch_confirmed(pairs):
+    """ Confirm every merge in a manifest with a single prompt """
+    print "Requesting to merge {} accounts:".format(len(pairs))
+    for tocp, fromcp in pairs:
+        print "    {} => {}".format(fromcp, tocp)
+    while "invalid input":
+        reply = str(raw_input('Is each tocp the primary cpanel that will remain after ' + \
+                    'its merge? (y/n): ')).lower().strip()
+        if reply[:1] == 'y':
+            return True
+        if reply[:1] == 'n':
+            return False
+class MergeResult:
+    """ Outcome of one merge, status is ok, errors or failed: <reason> """
+    def __init__(self, tocp, fromcp, status, seconds):
+        self.tocp = tocp
+        self.fromcp = fromcp
+        self.status = status
+        self.seconds = seconds
+    @property
+    def ok(self):
+        return self.status == 'ok'
+    def as_dict(self):
+        return {'tocp': self.tocp, 'fromcp': self.fromcp, 'status': self.status, 'seconds': self.seconds}
+def merge_pair(tocp, fromcp, resume=False):
+    """ Merge a pair without prompting, returns its MergeResult, never raises """
+    start = time.time()
+    f_handler = None
+    set_merge_context(tocp, fromcp)
+    try:
+        cp_obj = Cpmerge(tocp, fromcp, check_api=False, resume=resume)
+        f_handler = setup_logging(cp_obj, __name__)
+        logger.debug("Merging {} into {}".format(cp_obj.fromcp, cp_obj.tocp))
+        status = 'ok' if run_merge(cp_obj) else 'errors'
+    except MergeError as err:
+        # invalid users/domains only fail this merge, keep going with the rest of the batch
+        status = 'failed: {}'.format(err)
+        logger.error("Merge of {} into {} failed: {}".format(fromcp, tocp, err))
+    except Exception as err:
+        status = 'failed: {}'.format(err)
+        logger.exception("Merge of {} into {} failed".format(fromcp, tocp))
+    finally:
+        teardown_logging(f_handler)
+    return MergeResult(tocp, fromcp, status, time.time() - start)
+class MergeScheduler:
+    """
+    Run independent merges on a bounded pool of worker threads
+    Merges into the same tocp serialize on its target lock and every
+    cPanel API subprocess waits for a slot in API_SLOTS
+    """
+    def __init__(self, workers=1, resume=False):
+        self.workers = max(1, workers)
+        self.resume = resume
+        self.jobs = Queue.Queue()
+        self.results = {}
+        self.count = 0
+    def submit(self, tocp, fromcp):
+        """ Queue a merge, returns its job number """
+        job_id = self.count
+        self.jobs.put((job_id, tocp, fromcp))
+        self.count += 1
+        return job_id
+    def worker(self):
+        """ Take merges off the queue until it is empty """
+        while True:
+            try:
+                job_id, tocp, fromcp = self.jobs.get_nowait()
+            except Queue.Empty:
+                return
+            self.results[job_id] = merge_pair(tocp, fromcp, self.resume)
+    def run(self):
+        """ Run every queued merge, returns the summaries in submission order """
+        threads = []
+        for num in range(min(self.workers, self.count)):
+            thread = threading.Thread(target=self.worker, name='merge-worker-{}'.format(num))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # join with a timeout so ctrl-c still reaches the main thread
+            while thread.is_alive():
+                thread.join(0.5)
+        return [self.results[job_id] for job_id in sorted(self.results)]
+def merge_batch(pairs, workers=1, resume=False):
+    """ Merge every (tocp, fromcp) pair in one run, returns the per pair summary """
+    can_access_api()
+    scheduler = MergeScheduler(workers, resume)
+    for tocp, fromcp in pairs:
+        scheduler.submit(tocp, fromcp)
+    return scheduler.run()
+def report_batch(summary):
+    """ Log the outcome of each merge in a batch """
+    logger.info("Batch summary:")
+    for result in summary:
+        logger.info("    {} => {}: {} ({:.1f}s)".format(result.fromcp, result.tocp, result.status, \
+                    result.seconds))
+    failed = len([result for result in summary if not result.ok])
+    logger.info("{} of {} merges completed successfully".format(len(summary) - failed, len(summary)))
+    return failed == 0
+class DaemonServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+class DaemonRequestHandler(SocketServer.StreamRequestHandler):
+    """ Answer each json request line of a connection with a json line """
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError(line)
+            except ValueError:
+                answer = {'ok': False, 'error': 'invalid request'}
+            else:
+                answer = self.server.merge_daemon.handle(request)
+            self.wfile.write(json.dumps(answer, sort_keys=True) + '\n')
+            self.wfile.flush()
+class MergeDaemon:
+    """
+    Take merge jobs over a unix socket and run them on worker threads that
+    stay up, so pooled API connections and the inventory stay warm between
+    jobs, only the last keep finished jobs are remembered
+    requests, one json object per line:
+        {"action": "merge", "tocp": .., "fromcp": .., "resume": false}
+        {"action": "status", "job": id}
+        {"action": "jobs"}
+    """
+    def __init__(self, path, workers=1, keep=1000):
+        self.path = path
+        self.workers = max(1, workers)
+        self.keep = keep
+        self.queue = Queue.Queue()
+        self.jobs = {} # job id: state, accounts and once done the merge's result
+        self.count = 0
+        self.lock = threading.Lock()
+    def submit(self, tocp, fromcp, resume=False):
+        """ Queue a merge, returns its job id """
+        if not tocp or not fromcp or tocp == fromcp:
+            raise MergeError("A merge needs two different accounts")
+        tocp, fromcp = str(tocp), str(fromcp)
+        with self.lock:
+            # every fromcp is removed by its merge, it can't take part in another one meanwhile
+            for job in self.jobs.values():
+                if job['state'] != 'done' and (fromcp in (job['tocp'], job['fromcp']) or \
+                                               tocp == job['fromcp']):
+                    raise MergeError("{} => {} conflicts with job {}".format(fromcp, tocp, job['job']))
+            job_id = self.count
+            self.count += 1
+            self.jobs[job_id] = {'job': job_id, 'tocp': tocp, 'fromcp': fromcp, 'resume': resume, \
+                                 'state': 'queued', 'submitted': time.time()}
+        self.queue.put(job_id)
+        return job_id
+    def worker(self):
+        """ Run queued jobs for as long as the daemon runs """
+        while True:
+            job_id = self.queue.get()
+            with self.lock:
+                job = self.jobs[job_id]
+                job['state'] = 'running'
+            result = merge_pair(job['tocp'], job['fromcp'], job['resume'])
+            with self.lock:
+                job.update(result.as_dict())
+                job['state'] = 'done'
+                done = sorted(job_id for job_id in self.jobs if self.jobs[job_id]['state'] == 'done')
+                for job_id in done[:-self.keep]:
+                    del self.jobs[job_id]
+    def handle(self, request):
+        """ Answer one request """
+        action = request.get('action')
+        try:
+            if action == 'merge':
+                return {'ok': True, 'job': self.submit(request.get('tocp'), request.get('fromcp'), \
+                                                       bool(request.get('resume')))}
+            with self.lock:
+                if action == 'status':
+                    if request.get('job') not in self.jobs:
+                        return {'ok': False, 'error': 'unknown job {}'.format(request.get('job'))}
+                    return {'ok': True, 'job': dict(self.jobs[request['job']])}
+                if action == 'jobs':
+                    return {'ok': True, 'jobs': [dict(self.jobs[job_id]) for job_id in sorted(self.jobs)]}
+        except MergeError as err:
+            return {'ok': False, 'error': str(err)}
+        return {'ok': False, 'error': 'unknown action {}'.format(action)}
+    def serve(self):
+        """ Start the workers and answer requests until interrupted """
+        can_access_api()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        # only root may submit merges, the socket is created 0600 rather than chmodded after
+        umask = os.umask(0o177)
+        try:
+            server = DaemonServer(self.path, DaemonRequestHandler)
+        finally:
+            os.umask(umask)
+        server.merge_daemon = self
+        for num in range(self.workers):
+            thread = threading.Thread(target=self.worker, name='merge-worker-{}'.format(num))
+            thread.daemon = True
+            thread.start()
+        logger.info("Taking merge jobs on {} with {} workers".format(self.path, self.workers))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(self.path)
+def send_requests(path, requests):
+    """ Send requests to a running daemon, returns its answers in order """
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        stream = sock.makefile('rw')
+        answers = []
+        for request in requests:
+            stream.write(json.dumps(request) + '\n')
+            stream.flush()
+            answers.append(json.loads(stream.readline()))
+        stream.close()
+        sock.close()
+    except (socket.error, ValueError) as err:
+        raise MergeError("Unable to talk to the daemon on {}: {}".format(path, err))
+    return answers
 def main():
     """
     Merge two cpanel accounts
@@ -455,46 +3165,169 @@ def main():
     Actions:
         - creates a cp object to store data
         - moves all data to the tocp cpanel
-        - backs up DNS
+        - snapshots the zone, userdata and database files it changes
     Checks: valid cpanel users
     """
     parser = argparse.ArgumentParser(description='Merge two cpanel accounts')
     parser.add_argument('--tocp', \
-                        required=True, \
                         help='primary cpanel that will remain after merge')
     parser.add_argument('--fromcp', \
-                        required=True, \
                         help='cpanel that will not remain')
+    parser.add_argument('--manifest', \
+                        help='json/yaml/csv file of tocp/fromcp pairs to merge in one run')
+    parser.add_argument('--api-backend', choices=['cli', 'http', 'fake'], default='cli', \
+                        help='call cPanel APIs through the cli tools or keep-alive WHM API connections, ' \
+                        'fake answers every call locally for testing')
+    parser.add_argument('--fake-latency', type=float, default=0.0, \
+                        help='seconds each fake backend API call takes')
+    parser.add_argument('--root', default='', \
+                        help='look for /home, /var/named, /var/cpanel and /etc/passwd under this dir')
+    parser.add_argument('--api-url', default='https://127.0.0.1:2087', \
+                        help='WHM API url for the http backend')
+    parser.add_argument('--api-token-file', default='/root/.accesshash', \
+                        help='file holding the WHM API token for the http backend')
+    parser.add_argument('--domain-workers', type=int, default=DOMAIN_WORKERS, \
+                        help='per domain API calls each step runs at once')
+    parser.add_argument('--copy-workers', type=int, default=COPY_WORKERS, \
+                        help='files copied at once when moving across filesystems')
+    parser.add_argument('--mail-workers', type=int, default=MAIL_WORKERS, \
+                        help='mailboxes moved at once')
+    parser.add_argument('--workers', type=int, default=1, \
+                        help='number of manifest merges to run in parallel')
+    parser.add_argument('--api-limit', type=int, default=8, \
+                        help='max concurrent cPanel API subprocesses')
+    parser.add_argument('--dry-run', action='store_true', \
+                        help='only report what the merge would do, change nothing')
+    parser.add_argument('--plan-file', \
+                        help='with --dry-run, also write the plan as json to this file')
+    parser.add_argument('--resume', action='store_true', \
+                        help='continue an interrupted merge, skipping what its journal has done')
+    parser.add_argument('--prom-file', \
+                        help='write merge metrics to this prometheus textfile collector file')
+    parser.add_argument('--full-fixperms', action='store_true', \
+                        help='run /usr/bin/fixperms on all of tocp instead of only the merged paths')
+    parser.add_argument('--bulk-dns', action='store_true', \
+                        help='restore fromcp\'s own zones from the snapshot once the addons are re-added')
+    parser.add_argument('--serial-steps', action='store_true', \
+                        help='run the merge steps one after another instead of as a dependency graph')
+    parser.add_argument('--io-bandwidth', type=float, \
+                        help='MB/s all cross filesystem copies of the run may use together')
+    parser.add_argument('--io-iops', type=float, \
+                        help='files/s all cross filesystem copies of the run may copy together')
+    parser.add_argument('--min-free', type=float, default=MIN_FREE_FRACTION * 100, \
+                        help='percent of space and inodes to leave free where merges copy to')
+    parser.add_argument('--max-io-pressure', type=float, \
+                        help='hold copying merges back while io pressure (PSI some avg10) is above this')
+    parser.add_argument('--admission-wait', type=int, default=ADMISSION_WAIT, \
+                        help='seconds a merge waits for space or io before failing')
+    parser.add_argument('--presync', action='store_true', \
+                        help='copy cross filesystem docroots and mail ahead of the merge, repeatable')
+    parser.add_argument('--presync-checksum', action='store_true', \
+                        help='with --presync, compare file contents instead of size and mtime')
+    parser.add_argument('--daemon', metavar='SOCKET', \
+                        help='take merge jobs on this unix socket, --workers run at once')
+    parser.add_argument('--submit', metavar='SOCKET', \
+                        help='queue --tocp/--fromcp or --manifest merges on a running daemon')
+    parser.add_argument('--jobs', metavar='SOCKET', \
+                        help='list the jobs of a running daemon')
+    parser.add_argument('--rollback', action='store_true', \
+                        help='restore the config files snapshotted before the merge(s)')
+    parser.add_argument('--snapshot-dir', \
+                        help='where config snapshots are written and rolled back from ' \
+                        '(default {} under --root)'.format(SNAPSHOT_DIR))
     args = parser.parse_args()
-    cp_obj = Cpmerge(args.tocp, args.fromcp)
+    set_root(args.root)
+    set_snapshot_dir(args.snapshot_dir or ROOT + SNAPSHOT_DIR)
+    set_api_limit(args.api_limit)
+    set_domain_workers(args.domain_workers)
+    set_copy_workers(args.copy_workers)
+    set_mail_workers(args.mail_workers)
+    set_bulk_dns(args.bulk_dns)
+    set_serial_steps(args.serial_steps)
+    set_io_budget(args.io_bandwidth * 1048576 if args.io_bandwidth else None, args.io_iops)
+    set_admission(args.min_free / 100.0, args.max_io_pressure, args.admission_wait)
+    set_full_fixperms(args.full_fixperms)
+    set_prometheus_file(args.prom_file)
+    if args.api_backend == 'http':
+        try:
+            with open(args.api_token_file, 'r') as infile:
+                token = infile.read()
+        except IOError as err:
+            sys.exit("Unable to read API token: {}".format(os.strerror(err.errno)))
+        set_api_backend(HttpBackend(args.api_url, token, fallback=CliBackend()))
+    elif args.api_backend == 'fake':
+        set_api_backend(FakeBackend(args.fake_latency))
+    if args.daemon:
+        setup_logging_console(tag_merges=True)
+        MergeDaemon(args.daemon, args.workers).serve()
+        return
+    if args.jobs:
+        for job in send_requests(args.jobs, [{'action': 'jobs'}])[0]['jobs']:
+            print json.dumps(job, sort_keys=True)
+        return
+    if args.manifest and (args.tocp or args.fromcp):
+        parser.error('--manifest can not be combined with --tocp/--fromcp')
+    if not args.manifest and not (args.tocp and args.fromcp):
+        parser.error('--tocp and --fromcp are required without --manifest')
+    if args.dry_run and args.resume:
+        parser.error('--dry-run can not be combined with --resume')
+    if args.submit:
+        pairs = load_manifest(args.manifest) if args.manifest else [(args.tocp, args.fromcp)]
+        answers = send_requests(args.submit, [{'action': 'merge', 'tocp': tocp, 'fromcp': fromcp, \
+                                               'resume': args.resume} for tocp, fromcp in pairs])
+        for (tocp, fromcp), answer in zip(pairs, answers):
+            if answer['ok']:
+                print "{} => {}: job {}".format(fromcp, tocp, answer['job'])
+            else:
+                print "{} => {}: {}".format(fromcp, tocp, answer['error'])
+        if not all(answer['ok'] for answer in answers):
+            sys.exit(1)
+        return
+    if args.presync and (args.dry_run or args.resume or args.rollback):
+        parser.error('--presync can not be combined with --dry-run, --resume or --rollback')
+    if args.presync:
+        setup_logging_console()
+        pairs = load_manifest(args.manifest) if args.manifest else [(args.tocp, args.fromcp)]
+        if not presync(pairs, args.presync_checksum):
+            sys.exit(1)
+        return
+    if args.rollback and (args.dry_run or args.resume):
+        parser.error('--rollback can not be combined with --dry-run or --resume')
+    if args.rollback:
+        setup_logging_console()
+        pairs = load_manifest(args.manifest) if args.manifest else [(args.tocp, args.fromcp)]
+        if not is_rollback_confirmed(rollback_archives(pairs)):
+            print "Exiting."
+            return
+        if not rollback_pairs(pairs):
+            sys.exit(1)
+        return
+    if args.dry_run:
+        setup_logging_console()
+        pairs = load_manifest(args.manifest) if args.manifest else [(args.tocp, args.fromcp)]
+        if not dry_run(pairs, args.plan_file):
+            sys.exit(1)
+        return
+    if args.manifest:
+        pairs = load_manifest(args.manifest)
+        setup_logging_console(tag_merges=args.workers > 1)
+        if is_batch_confirmed(pairs):
+            if not report_batch(merge_batch(pairs, args.workers, args.resume)):
+                sys.exit(1)
+        else:
+            print "Exiting."
+        return
+    cp_obj = Cpmerge(args.tocp, args.fromcp, resume=args.resume)
     setup_logging(cp_obj, __name__)
     logger.debug("Merging {} into {}".format(cp_obj.fromcp, cp_obj.tocp))
     if is_confirmed(cp_obj):
-        """
-        - Move docroots/conf files before renaming main cpanel
-        - Must add main domain before we can add subdomains
-        """
-        backupdns(cp_obj)
-        move_maildirs(cp_obj)
-        move_docroots(cp_obj)
-        del_addons(cp_obj)
-        add_addons(cp_obj)
-        rename_main(cp_obj)
-        add_main(cp_obj)
-        add_subdomains(cp_obj)
-        reassign_dbs(cp_obj)
-        fix_perms(cp_obj)
-        if not cp_obj.has_errors:
-            logger.info("Moving homedir...")
-            move_homedir(cp_obj)
-        if cp_obj.has_errors:
-            logger.info("Completed with errors: please check the .imh/cpmerge.log for errors")
-        else:
-            logger.info("Completed successfully!")
+        run_merge(cp_obj)
     else:
         print "Exiting."
 if __name__ == '__main__':
     try:
         main()
+    except MergeError as err:
+        sys.exit(str(err))
     except KeyboardInterrupt:
         sys.exit()
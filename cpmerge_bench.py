@@ -0,0 +1,297 @@
+#!/usr/bin/python
+"""
+Purpose:
+    - measure how fast cpmerge.py merges without a cPanel server
+Actions:
+    - generates two synthetic accounts under a root prefix
+    - merges them with the fake API backend
+    - reports the wall time and throughput of each merge step
+    - optionally compares against a saved baseline to catch regressions
+"""
+import sys
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import json
+import logging
+import threading
+import BaseHTTPServer
+import SocketServer
+import yaml
+import cpmerge
+TOCP = 'benchto'
+FROMCP = 'benchfrom'
+# what each step's throughput is counted in
+STEP_UNITS = {'snapshot_configs': 'files', 'move_maildirs': 'mailboxes', 'move_docroots': 'docroots', \
+              'del_addons': 'addons', 'add_addons': 'addons', 'rename_main': 'domains', \
+              'add_main': 'domains', 'add_subdomains': 'subdomains', 'reassign_dbs': 'databases', \
+              'fix_perms': 'entries', 'move_homedir': 'dirs'}
+def write_file(path, data):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(path, 'w') as outfile:
+        outfile.write(data)
+def write_yaml(path, data):
+    write_file(path, yaml.safe_dump(data, default_flow_style=False))
+def make_docroot(path, files, size):
+    """ Fill a docroot with sparse files adding up to size bytes """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for num in range(files):
+        with open(os.path.join(path, 'file{}.html'.format(num)), 'w') as outfile:
+            outfile.truncate(size // max(1, files))
+def make_mailbox(path, messages):
+    """ A maildir of 2KB messages named the way dovecot names them """
+    for sub in ('cur', 'new', 'tmp'):
+        os.makedirs(os.path.join(path, sub))
+    for num in range(messages):
+        write_file(os.path.join(path, 'cur', '{}.M{}P1.bench,S=2048:2,S'.format(int(time.time()), num)), \
+                   'x' * 2048)
+def make_account(root, user, main, addons, subdomains, mailboxes, messages, databases, files, size):
+    """ Home dir, userdata, zones and database files of one synthetic account """
+    home = root + '/home/' + user
+    userdata = root + '/var/cpanel/userdata/' + user
+    for sub in ('mail', 'etc', 'public_html'):
+        os.makedirs(os.path.join(home, sub))
+    make_docroot(home + '/public_html', files, size)
+    domains = [main]
+    addon_domains = {}
+    for num in range(addons):
+        # a different name than its subdomain, as cPanel has them
+        addon = 'addon{}-{}.example'.format(num, user)
+        subdomain = 'addon{}.{}'.format(num, main)
+        addon_domains[addon] = subdomain
+        docroot = home + '/public_html/' + addon
+        make_docroot(docroot, files, size)
+        write_yaml(userdata + '/' + subdomain, {'documentroot': docroot, 'servername': subdomain})
+        domains.append(addon)
+    sub_domains = list(addon_domains.values())
+    for num in range(subdomains):
+        subdomain = 'sub{}.{}'.format(num, main)
+        docroot = home + '/public_html/sub' + str(num)
+        make_docroot(docroot, files, size)
+        write_yaml(userdata + '/' + subdomain, {'documentroot': docroot, 'servername': subdomain})
+        sub_domains.append(subdomain)
+        domains.append(subdomain)
+    write_yaml(userdata + '/' + main, {'documentroot': home + '/public_html', 'servername': main})
+    write_yaml(userdata + '/main', {'main_domain': main, 'addon_domains': addon_domains, \
+                                    'sub_domains': sub_domains, 'parked_domains': []})
+    for domain in [main] + list(addon_domains):
+        write_file(root + '/var/named/' + domain + '.db', '$ORIGIN {}.\n@ 14400 IN A 127.0.0.1\n'.format(domain))
+    # mailboxes are dealt round robin to every domain
+    quotas = {}
+    for num in range(mailboxes):
+        domain = domains[num % len(domains)]
+        make_mailbox('{}/mail/{}/user{}'.format(home, domain, num), messages)
+        quotas.setdefault(domain, []).append('user{}:{}\n'.format(num, 1024 * 1024 * 1024))
+    for domain, lines in quotas.items():
+        write_file(home + '/etc/' + domain + '/quota', ''.join(lines))
+    dbs = dict(('{}_db{}'.format(user, num), user) for num in range(databases))
+    dbusers = dict(('{}_user{}'.format(user, num), {'dbs': {'{}_db{}'.format(user, num): 1}}) \
+                   for num in range(databases))
+    db_json = {'MYSQL': {'dbs': dbs, 'dbusers': dbusers, 'noprefix': {}, 'owner': user, 'server': ''}, \
+               'PGSQL': {}}
+    write_file(root + '/var/cpanel/databases/' + user + '.json', json.dumps(db_json))
+    write_yaml(root + '/var/cpanel/databases/grants_' + user + '.yaml', \
+               {'MYSQL': {user: dict((dbuser, ['GRANT USAGE']) for dbuser in dbusers)}})
+def make_root(root, args):
+    """ Both synthetic accounts and a passwd with them under root """
+    uid, gid = os.getuid(), os.getgid()
+    write_file(root + '/etc/passwd', ''.join('{0}:x:{1}:{2}::{3}/home/{0}:/bin/bash\n'.format( \
+               user, uid, gid, root) for user in (TOCP, FROMCP, 'nobody')))
+    size = args.docroot_mb * 1024 * 1024
+    make_account(root, TOCP, TOCP + '.test', 0, 0, 0, 0, 0, 1, 0)
+    make_account(root, FROMCP, FROMCP + '.test', args.addons, args.subdomains, args.mailboxes, \
+                 args.messages, args.databases, args.files, size)
+def step_items(args):
+    """ Units of work each step does for the generated fromcp """
+    docroots = args.addons + args.subdomains + 1
+    return {'snapshot_configs': 2 * args.addons + args.subdomains + 10, 'move_maildirs': args.mailboxes, \
+            'move_docroots': docroots, 'del_addons': args.addons, 'add_addons': args.addons, \
+            'rename_main': 1, 'add_main': 1, 'add_subdomains': args.subdomains, \
+            'reassign_dbs': args.databases, 'fix_perms': docroots * (args.files + 1) + \
+            args.mailboxes * (args.messages + 4), 'move_homedir': 1}
+def run_once(args, run):
+    """ Generate a fresh root, merge it and return {step: seconds} """
+    root = tempfile.mkdtemp(prefix='cpmerge-bench-', dir=args.work_dir)
+    try:
+        make_root(root, args)
+        cpmerge.set_root(root)
+        cpmerge.set_snapshot_dir(root + '/snapshots')
+        cp_obj = cpmerge.Cpmerge(TOCP, FROMCP)
+        f_handler = cpmerge.setup_logging(cp_obj, cpmerge.__name__)
+        try:
+            ok = cpmerge.run_merge(cp_obj)
+        finally:
+            cpmerge.teardown_logging(f_handler)
+        if not ok:
+            sys.exit("Run {} finished with errors, see {}/home/{}/.imh/cpmerge.log".format(run, root, TOCP))
+        steps = {}
+        for name, seconds, errors in cp_obj.metrics.steps:
+            steps[name] = steps.get(name, 0.0) + seconds
+        steps['total'] = cp_obj.metrics.seconds
+        return steps
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+def report(results, items):
+    """ Print mean/min seconds and throughput of each step """
+    print "{:<18} {:>10} {:>10} {:>14}".format('step', 'mean s', 'min s', 'throughput')
+    for name in sorted(results, key=lambda name: (name == 'total', name)):
+        times = results[name]
+        mean = sum(times) / len(times)
+        rate = ''
+        if name in items and items[name]:
+            rate = '{:.1f} {}/s'.format(items[name] / mean, STEP_UNITS[name]) if mean else 'inf'
+        print "{:<18} {:>10.3f} {:>10.3f} {:>14}".format(name, mean, min(times), rate)
+def compare(results, baseline_path, tolerance):
+    """ Steps whose mean got more than tolerance slower than the baseline's """
+    with open(baseline_path, 'r') as infile:
+        baseline = json.load(infile)['steps']
+    slower = []
+    for name, times in sorted(results.items()):
+        mean = sum(times) / len(times)
+        base = baseline.get(name)
+        # steps this fast are all noise
+        if base and mean > 0.05 and mean > base * (1 + tolerance):
+            slower.append("{} {:.3f}s, baseline {:.3f}s".format(name, mean, base))
+    return slower
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    def handle_error(self, request, client_address):
+        # the client hangs up on slow requests before they are answered
+        pass
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answer json-api requests with success over keep-alive connections
+    /json-api/slow answers after STUB_DELAY seconds, /json-api/close closes
+    the connection after answering without telling the client
+    """
+    protocol_version = 'HTTP/1.1'
+    def do_GET(self):
+        func = self.path.split('?')[0].split('/')[-1]
+        with self.server.lock:
+            self.server.requests.append(func)
+            self.server.connections.add(self.client_address)
+        if func == 'slow':
+            time.sleep(STUB_DELAY)
+        body = json.dumps({'metadata': {'result': 1}, 'data': {}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if func == 'close':
+            self.close_connection = 1
+    def log_message(self, format, *args):
+        pass
+STUB_DELAY = 1.0
+class RecordingBackend:
+    """ Fallback that only records the calls it gets """
+    def __init__(self):
+        self.calls = []
+    def call(self, api, func, args, user=None, module=None):
+        self.calls.append(func)
+        return cpmerge.ApiResult(api, json.dumps({'metadata': {'result': 1}, 'data': {}}))
+def check_http_backend():
+    """
+    Run HttpBackend against a local stub json-api, returns what went wrong:
+    calls from any thread share one connection, a server side close of an
+    idle connection is retried, a timed out call is neither resent nor sent
+    to the fallback, and only an unreachable port uses the fallback
+    """
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.connections = set()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    failures = []
+    try:
+        fallback = RecordingBackend()
+        backend = cpmerge.HttpBackend(url, 'token', fallback, timeout=STUB_DELAY / 4)
+        results = [backend.call('whmapi1', 'version', {}) for num in range(3)]
+        worker = threading.Thread(target=lambda: results.append(backend.call('whmapi1', 'version', {})))
+        worker.start()
+        worker.join()
+        if not all(result.ok for result in results) or len(server.connections) != 1:
+            failures.append("4 calls from 2 threads used {} connections".format(len(server.connections)))
+        backend.call('whmapi1', 'close', {})
+        if not backend.call('whmapi1', 'version', {}).ok or server.requests.count('version') != 5:
+            failures.append("a call on a connection the server closed was not retried")
+        if backend.call('whmapi1', 'slow', {}).ok:
+            failures.append("a timed out call succeeded")
+        time.sleep(STUB_DELAY)
+        if server.requests.count('slow') != 1 or fallback.calls:
+            failures.append("a timed out call was sent {} times and {} times to the fallback".format( \
+                            server.requests.count('slow'), len(fallback.calls)))
+    finally:
+        server.shutdown()
+        server.server_close()
+    result = cpmerge.HttpBackend(url, 'token', fallback).call('whmapi1', 'version', {})
+    if not result.ok or fallback.calls != ['version']:
+        failures.append("an unreachable API did not fall back to the cli")
+    return failures
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cpmerge.py on synthetic accounts')
+    parser.add_argument('--addons', type=int, default=20, help='addon domains on fromcp')
+    parser.add_argument('--subdomains', type=int, default=20, help='subdomains on fromcp')
+    parser.add_argument('--mailboxes', type=int, default=100, help='mailboxes spread over fromcp\'s domains')
+    parser.add_argument('--messages', type=int, default=10, help='messages in each mailbox')
+    parser.add_argument('--databases', type=int, default=10, help='mysql databases on fromcp')
+    parser.add_argument('--files', type=int, default=10, help='files in each docroot')
+    parser.add_argument('--docroot-mb', type=int, default=1, help='MB of sparse files in each docroot')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds each fake API call takes')
+    parser.add_argument('--runs', type=int, default=3, help='merges to time, each on a fresh root')
+    parser.add_argument('--work-dir', help='where roots are generated, default the system temp dir')
+    parser.add_argument('--keep', action='store_true', help='keep the generated roots')
+    parser.add_argument('--domain-workers', type=int, default=cpmerge.DOMAIN_WORKERS)
+    parser.add_argument('--mail-workers', type=int, default=cpmerge.MAIL_WORKERS)
+    parser.add_argument('--api-limit', type=int, default=8)
+    parser.add_argument('--serial-steps', action='store_true', help='run the steps one after another')
+    parser.add_argument('--json', help='write the mean seconds per step to this file')
+    parser.add_argument('--baseline', help='json written by an earlier --json run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, \
+                        help='fraction a step may be slower than the baseline')
+    parser.add_argument('--check-http', action='store_true', \
+                        help='check the http API backend against a local stub server instead')
+    args = parser.parse_args()
+    if args.check_http:
+        failures = check_http_backend()
+        for line in failures:
+            print "Failed: " + line
+        if failures:
+            sys.exit(1)
+        print "HttpBackend checks passed"
+        return
+    # only warnings on the console, each run's full log is in its tocp's .imh
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.WARNING)
+    cpmerge.logger.addHandler(handler)
+    cpmerge.set_api_backend(cpmerge.FakeBackend(args.latency))
+    cpmerge.set_api_limit(args.api_limit)
+    cpmerge.set_domain_workers(args.domain_workers)
+    cpmerge.set_mail_workers(args.mail_workers)
+    cpmerge.set_serial_steps(args.serial_steps)
+    results = {}
+    for run in range(args.runs):
+        for name, seconds in run_once(args, run).items():
+            results.setdefault(name, []).append(seconds)
+    report(results, step_items(args))
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump({'args': vars(args), 'steps': dict((name, sum(times) / len(times)) \
+                       for name, times in results.items())}, outfile, indent=2, sort_keys=True)
+    if args.baseline:
+        slower = compare(results, args.baseline, args.tolerance)
+        for line in slower:
+            print "Regression: " + line
+        if slower:
+            sys.exit(1)
+if __name__ == '__main__':
+    main()